@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# offline benchmark of ocsh own overhead, using stub ssh / pass / sshpass / ssh-keygen executables
+# and synthetic ssh_config(5) files. results are written as JSON.
+# start time regression check, as used before releases:
+#   scripts/bench.py -n 10,50000 -o /dev/null --max-startup-ms 150
+# the limit depends on the machine: 150ms is for the release machine. on another machine, take about twice the
+# overhead measured for 10 hosts, as configuration size should not change it much. tests/test_startup.py checks the latter
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+path_src = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(path_src))
+import ocsh
+
+OCSH = path_src / "ocsh.py"
+
+STUBS = {
+    # ssh: answer 'ssh -G' like OpenSSH, report no master connection, otherwise succeed immediately
+    'ssh': """#!/bin/sh
+for a; do
+    [ "$a" = "-G" ] && { eval host=\\${$#}; printf "hostname %s\\nport 22\\nstricthostkeychecking true\\nuserknownhostsfile ~/.ssh/known_hosts\\n" "$host"; exit 0; }
+    [ "$a" = "-O" ] && exit 255
+done
+exit 0
+""",
+    'pass': """#!/bin/sh
+echo "secret-$1"
+""",
+    'sshpass': """#!/bin/sh
+shift
+exec "$@"
+""",
+    'ssh-keygen': """#!/bin/sh
+exit 0
+""",
+}
+
+def write_stubs(bindir):
+    bindir.mkdir(parents=True, exist_ok=True)
+    for name, content in STUBS.items():
+        f = bindir / name
+        f.write_text(content)
+        f.chmod(0o755)
+
+def write_config(confdir, hosts, include_depth, jump_depth, pattern_blocks=0):
+    """ write a ssh_config(5) with hosts spread over a chain of include_depth Include files, every host annotated.
+    the first jump_depth hosts form a ProxyJump chain ending on host 'jumpchain'.
+    pattern_blocks annotated Host blocks with wildcard and negated patterns follow the hosts """
+    confdir.mkdir(parents=True, exist_ok=True)
+    files = [confdir / ("config%d" % i) for i in range(include_depth + 1)]
+    blocks = [list() for _ in files]
+    for i in range(hosts):
+        blocks[i % len(files)].append("""Host host{i}
+    Hostname 10.{a}.{b}.{c}
+    User user{i}
+    # ocsh pass bench/host{i}
+    # ocsh post nsep "ip netns exec ns{i}"
+    # ocsh postpass su "su -l" bench/root{i}
+""".format(i=i, a=(i >> 16) & 255, b=(i >> 8) & 255, c=i & 255))
+    for i in range(jump_depth):
+        blocks[0].append("""Host jump{i}
+    Hostname 10.255.0.{i}
+    # ocsh pass bench/jump{i}
+{proxy}""".format(i=i, proxy="    ProxyJump jump%d\n" % (i - 1) if i > 0 else ""))
+    blocks[0].append("""Host jumpchain
+    Hostname 10.255.1.1
+    # ocsh pass bench/jumpchain
+{proxy}""".format(proxy="    ProxyJump jump%d\n" % (jump_depth - 1) if jump_depth > 0 else ""))
+    for i in range(pattern_blocks):
+        blocks[-1].append("""Host host{i}?* !host{i}0
+    # ocsh post pat{i} "echo {i}"
+""".format(i=i))
+    for i, f in enumerate(files):
+        include = "Include %s\n" % files[i+1] if i + 1 < len(files) else ""
+        f.write_text(include + "\n".join(blocks[i]))
+    return files[0]
+
+def write_known_hosts(home, hosts, jump_depth):
+    """ write a known_hosts(5) with a key for every generated host, as checked with StrictHostKeyChecking """
+    names = ["host%d" % i for i in range(hosts)] + ["jump%d" % i for i in range(jump_depth)] + ["jumpchain"]
+    path = home / ".ssh/known_hosts"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join("%s ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIbench\n" % name for name in names))
+
+def timed(func, repeat):
+    durations = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return { 'min': min(durations), 'median': statistics.median(durations), 'max': max(durations) }
+
+def ocsh_run(env, *args):
+    res = subprocess.run([sys.executable, str(OCSH)] + list(args), env=env, capture_output=True)
+    if res.returncode != 0:
+        raise Exception("ocsh %s failed: %s" % (' '.join(args), res.stderr.decode()))
+
+def bench(workdir, hosts, include_depth, jump_depth, pattern_blocks, repeat):
+    home = workdir / ("home-%d" % hosts)
+    conf = write_config(workdir / ("conf-%d" % hosts), hosts, include_depth, jump_depth, pattern_blocks)
+    write_known_hosts(home, hosts, jump_depth)
+    env = dict(os.environ, HOME=str(home), PATH="%s:%s" % (workdir / "bin", os.environ['PATH']))
+    env.pop('OCSH_AGENT_SOCK', None)
+    env.pop('XDG_RUNTIME_DIR', None)
+    cache = home / ".cache/ocsh"
+
+    def cold():
+        subprocess.run(["rm", "-rf", str(cache)])
+        ocsh_run(env, "-F", str(conf), "--ocsh-pretend", "host0")
+
+    return {
+        'hosts': hosts,
+        'include_depth': include_depth,
+        'jump_depth': jump_depth,
+        'pattern_blocks': pattern_blocks,
+        'interpreter': timed(lambda: subprocess.run([sys.executable, "-c", "pass"]), repeat),
+        'parse': timed(lambda: ocsh.Sshconf(conf, cache_dir=None), repeat),
+        'cold_start': timed(cold, repeat),
+        'warm_start': timed(lambda: ocsh_run(env, "-F", str(conf), "--ocsh-pretend", "host0"), repeat),
+        'multihost_expansion': timed(lambda: ocsh_run(env, "-F", str(conf), "--ocsh-pretend", "host1.*"), repeat),
+        'proxyjump_chain': timed(lambda: ocsh_run(env, "-F", str(conf), "jumpchain", "true"), repeat),
+        'transport': timed(lambda: ocsh_run(env, "-F", str(conf), "-W", "10.0.0.1:22", "host0"), repeat),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark of ocsh overhead, results in JSON")
+    parser.add_argument('-n', '--hosts', default="10,1000,50000", help="comma separated list of number of hosts in generated configurations (default: %(default)s)")
+    parser.add_argument('-i', '--include-depth', type=int, default=8, help="depth of generated Include chain (default: %(default)s)")
+    parser.add_argument('-j', '--jump-depth', type=int, default=3, help="number of hops of generated ProxyJump chain (default: %(default)s)")
+    parser.add_argument('-p', '--pattern-blocks', type=int, default=100, help="number of Host blocks with patterns in generated configurations (default: %(default)s)")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="runs per measurement (default: %(default)s)")
+    parser.add_argument('-o', '--output', help="write results to file instead of stdout")
+    parser.add_argument('-m', '--max-startup-ms', type=float, help="fail if warm start or transport invocation of ocsh takes more than this, interpreter start excluded")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="ocsh-bench-") as tmp:
+        workdir = Path(tmp)
+        write_stubs(workdir / "bin")
+        results = {
+            'ocsh_version': ocsh.VERSION,
+            'python': sys.version.split()[0],
+            'runs': [bench(workdir, int(n), args.include_depth, args.jump_depth, args.pattern_blocks, args.repeat) for n in args.hosts.split(',')],
+        }
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(out + "\n")
+        print("[*] DONE, wrote %s" % args.output)
+    else:
+        print(out)
+
+    if args.max_startup_ms:
+        failed = False
+        for run in results['runs']:
+            for name in ['warm_start', 'transport']:
+                overhead = (run[name]['median'] - run['interpreter']['median']) * 1000
+                ok = overhead <= args.max_startup_ms
+                failed |= not ok
+                print("[%s] %d hosts, %s: %.1fms over interpreter start (max %.1fms)" % ("OK" if ok else "FAIL", run['hosts'], name, overhead, args.max_startup_ms), file=sys.stderr)
+        return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,24 +15,53 @@ SUMMARY = f"""ocsh automates SSH password login and command execution through an
 * post-login command execution, reading additional password from pass[1]:
   - config:  `# ocsh postpass <action> "<cmd>" <pass-name>`
   - command: `$ ocsh host[action]`
+* reuse of a master connection, skipping password authentication, kept open for <persist> time after last use:
+  - config:  `# ocsh master [<persist>]`
+  - command: `$ ocsh host`
+* post-login actions waiting for shell and password prompts, with per-host patterns and timeout:
+  - config:  `# ocsh prompt "<regex>"`
+  - config:  `# ocsh passprompt "<regex>"`
+  - config:  `# ocsh posttimeout <seconds>`
+* password login by the built-in pexpect engine instead of sshpass:
+  - config:  `# ocsh login pexpect`
+  - command: `$ ocsh host`
 * use different ssh command or prefix by other command:
   - config:  `# ocsh cmd "<ssh-command>"`
   - config:  `# ocsh pre "<pre-command>"`
   - command: `$ ocsh host`
+* jump hosts chains from ProxyJump or -J, each hop using its own annotations:
+  - command: `$ ocsh -J jump1,jump2 host`
 * multiple hosts support for command execution:
   - command: `$ ocsh sshaliasprefix*`
+  - command: `$ ocsh --ocsh-parallel 20 --ocsh-timeout 30 sshaliasprefix* 'uptime'`
+* batch of commands over a single log-in and post actions, with JSON exit code, output and duration of each command:
+  - command: `$ ocsh --ocsh-batch commands.txt host[action]`
+* commands on shells kept open after post actions by a session broker, skipping log-in and post actions:
+  - command: `$ ocsh --ocsh-broker --ocsh-broker-idle 600 &`
+  - command: `$ ocsh host[action] 'cmd'`
+* output of multiple hosts as JSON lines records, bounded per host:
+  - command: `$ ocsh --ocsh-output jsonl --ocsh-output-max 1048576 --ocsh-output-spill /tmp/out sshaliasprefix* 'cmd'`
+* alternate routes, tried in parallel with the configured one, the first getting the SSH banner being used:
+  - config:  `# ocsh alt [jump=<jump1,jump2>|jump=none] [hostname=<address>]`
+  - command: `$ ocsh host`
+* python asyncio API, running commands on many hosts from a single event loop with structured results:
+  - python:  `await ocsh.Octossh(ocsh.Sshconf(path), "host").run_command("cmd")`
 
 [1] https://www.passwordstore.org/
 
 Compatibility with OpenSSH is kept as much as possible:
 * support usual SSH aliases, keys and command-line options
+* annotations of Host blocks with patterns, and of Match all / host / originalhost / localuser blocks, apply to matching hosts, the first obtained value being used
 * compatible with rsync, scp and other tools using SSH for transport, see example commands
-* autocompletion can be set-up with --ocsh-install-autocompletion
+* autocompletion of hosts and host[action] can be set-up with --ocsh-install-autocompletion
+
+The parsed ssh_config(5) is cached in ~/.cache/ocsh/ and rebuilt when any of its included files change.
+Secrets read from pass[1] can be kept in memory by an agent started with --ocsh-agent.
 
 v{VERSION}
 See also --ocsh-examples
 """
-EXAMPLES = """# connect to SSH alias 'host1' with automated password login
+EXAMPLES = r"""# connect to SSH alias 'host1' with automated password login
 # ssh_config(5)
 Host host1
    Hostname 10.0.0.1
@@ -72,36 +101,578 @@ ip netns exec ssh host1
 rsync -e "ocsh" -avP host1:/etc/hosts /tmp/
 
 # run scp through ocsh from host1 with automated password login
-scp -S "ocsh" host1:/etc/hosts /tmp/"""
+scp -S "ocsh" host1:/etc/hosts /tmp/
+
+# keep a master connection to 'host1' open for 30 minutes, so that rsync / scp do not log-in again for each transfer
+# ssh_config(5)
+Host host1
+   Hostname 10.0.0.1
+   # ocsh pass pass-location
+   # ocsh master 30m
+# commands
+rsync -e "ocsh" -avP host1:/etc/hosts /tmp/
+ocsh --ocsh-masters
+ocsh --ocsh-masters-close host1
+
+# keep secrets read from pass in memory for 1 hour, for all ocsh invocations of the current user
+ocsh --ocsh-agent --ocsh-agent-ttl 3600 &
+# forget all secrets kept by the agent
+ocsh --ocsh-agent-flush
+
+# run a command on all hosts starting with 'web', 20 hosts at a time, giving up on a host after 30 seconds
+ocsh --ocsh-parallel 20 --ocsh-timeout 30 'web*' uptime
+
+# same as JSON lines records, keeping at most 1MB of output per host and writing the rest to /tmp/out/<host>.<stream>
+ocsh --ocsh-output jsonl --ocsh-output-spill /tmp/out --ocsh-parallel 20 --ocsh-timeout 30 'web*' 'journalctl -b' | jq -r 'select(.stream == "exit") | "\(.host) \(.exit)"'
+
+# run commands as root on 'host2', logging-in and becoming root once, and print one JSON result per command
+printf 'id -u\nsystemctl is-active sshd\n' | ocsh --ocsh-batch - host2[su]
+
+# keep root shells on 'host2' open for 10 minutes after last use, at most 2 at a time, and run commands on them
+ocsh --ocsh-broker --ocsh-broker-idle 600 --ocsh-broker-max 2 &
+ocsh host2[su] 'systemctl restart sshd'
+ocsh --ocsh-sessions
+ocsh --ocsh-sessions-close host2
+
+# reach 'host3' through jump1, or through jump2 or its second address if jump1 does not answer first
+# routes that did not answer are skipped for 60 seconds by later invocations, see --ocsh-unreachable-ttl
+# ssh_config(5)
+Host host3
+    Hostname 10.1.0.3
+    ProxyJump jump1
+    # ocsh pass pass-location4
+    # ocsh alt jump=jump2
+    # ocsh alt jump=none hostname=192.0.2.3
+# command
+ocsh host3
+
+# apply annotations to all hosts starting with 'web' except 'web-test', and add a post action to those with an address in 10.0.0.0/24
+# ssh_config(5)
+Host web-* !web-test
+    # ocsh pass pass-location-web
+    # ocsh postpass su "su -l" pass-location-web-root
+Match host 10.0.0.*
+    # ocsh post nsep "ip netns exec nsep"
+# command
+ocsh web-01[su]
+
+# python library API, running a command on all hosts starting with 'web' from a single event loop
+import asyncio, ocsh
+conf = ocsh.Sshconf(ocsh.Sshconf.CONFPATH_DEFAULT)
+async def uptimes():
+    return await asyncio.gather(*[ocsh.Octossh(conf, host).run_command("uptime", timeout=30) for host in conf.expand("web.*")])
+for result in asyncio.run(uptimes()):
+    print(result['host'], result['exit'], result['stdout'], result['timings'])"""
 
 import os
 import re
 import sys
+import json
+import time
+import glob
+import shlex
+import atexit
+import pickle
+import bisect
 import shutil
+import signal
+import hashlib
+import zlib
 import logging
 import tempfile
 import argparse
+import itertools
+import threading
+import contextlib
+import contextvars
 import subprocess
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
 from logging import info, debug, warning, error
 
-import pexpect
+# pexpect, socket and other modules not needed by every invocation are imported where used,
+# since ocsh start time adds to each hop and transfer when used as ProxyCommand or transport
+
+@lru_cache(maxsize=None)
+def which(cmd):
+    return shutil.which(cmd)
+
+def write_atomic(path, data):
+    """ write bytes data to path through a temporary file renamed over it, so that concurrent ocsh processes never read
+    a partial file. raises OSError """
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".%s-" % path.name)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+class OcshError(Exception):
+    pass
+
+class Profile(object):
+    """ records durations of ocsh phases as Chrome trace events. the trace file is shared with nested ocsh processes,
+    which find it in the environment and append their own events """
+    ENV = "OCSH_PROFILE"
+
+    def __init__(self):
+        self.path = None
+        self.start = time.time()
+        self.timings = contextvars.ContextVar('timings', default=None) # phase name -> total duration, for the current task
+
+
+    def enable(self, path, root=True):
+        self.path = Path(path).absolute()
+        os.environ[self.ENV] = str(self.path)
+        if root:
+            self.path.write_text("[\n") # JSON array format, closing bracket is optional
+        atexit.register(self._exit, root)
+
+    @contextlib.contextmanager
+    def phase(self, name, host=None):
+        timings = self.timings.get()
+        if not self.path and timings is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            if timings is not None:
+                timings[name] = timings.get(name, 0) + duration
+            if self.path:
+                self._record(name, start, duration, host)
+
+    def _record(self, name, start, duration, host=None):
+        event = { 'name': name, 'cat': "ocsh", 'ph': "X", 'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+                  'pid': os.getpid(), 'tid': threading.get_ident(), 'args': { 'host': host, 'argv': ' '.join(sys.argv[1:]) } }
+        # a single write with O_APPEND, so that concurrent processes do not interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, json.dumps(event).encode() + b",\n")
+        finally:
+            os.close(fd)
+
+    def _exit(self, root):
+        self._record("ocsh", self.start, time.time() - self.start)
+        if root:
+            info("profile: %s, trace written to %s" % (self.summary(), self.path))
+
+    def summary(self):
+        """ one line summary of phase durations in all processes, with percentiles across hosts for multi-host runs """
+        phases = defaultdict(list)
+        hosts = set()
+        for line in self.path.read_text().split("\n")[1:]:
+            if line:
+                event = json.loads(line.rstrip(','))
+                if event['name'] == "ocsh" and event['pid'] != os.getpid():
+                    continue # nested ocsh processes totals are already part of their parent phases
+                phases[event['name']].append(event['dur'] / 1e6)
+                hosts.add(event['args']['host'])
+        hosts.discard(None)
+        summary = list()
+        for name, durations in phases.items():
+            durations.sort()
+            if len(hosts) > 1 and name != "ocsh":
+                pct = lambda p: durations[min(len(durations) - 1, int(len(durations) * p))]
+                summary.append("%s p50 %.3fs p90 %.3fs max %.3fs" % (name, pct(0.5), pct(0.9), durations[-1]))
+            else:
+                summary.append("%s %.3fs" % (name, sum(durations)))
+        if len(hosts) > 1:
+            summary.insert(0, "%d hosts" % len(hosts))
+        return ', '.join(summary)
+
+PROFILE = Profile()
+
+class Lazyhosts(dict):
+    """ hosts loaded from cache, each host configuration being unpickled on first access.
+    a transport or ProxyCommand invocation only needs a few hosts out of the whole configuration, so for large configurations
+    Host lines of a single literal name are kept in nbuckets cache files, each one read by load_bucket(n) on first access """
+    def __init__(self, hosts, nbuckets=0, load_bucket=None):
+        super().__init__(hosts)
+        self.nbuckets = nbuckets
+        self.load_bucket = load_bucket
+        self.loaded = set() # buckets already read
+
+    @staticmethod
+    def bucket(host, nbuckets):
+        return zlib.crc32(host.encode()) % nbuckets
+
+    def _load(self, host):
+        n = self.bucket(host, self.nbuckets)
+        if n not in self.loaded:
+            self.loaded.add(n)
+            self.update((h, conf) for h, conf in self.load_bucket(n).items() if not dict.__contains__(self, h))
+
+    def __contains__(self, host):
+        if self.nbuckets and not super().__contains__(host):
+            self._load(host)
+        return super().__contains__(host)
+
+    def __iter__(self):
+        for n in range(self.nbuckets):
+            if n not in self.loaded:
+                self.loaded.add(n)
+                self.update(self.load_bucket(n))
+        return super().__iter__()
+
+    def __getitem__(self, host):
+        if self.nbuckets and not super().__contains__(host):
+            self._load(host)
+        conf = super().__getitem__(host)
+        if isinstance(conf, bytes):
+            conf = pickle.loads(conf)
+            self[host] = conf
+        return conf
+
+    def get(self, host, default=None):
+        return self[host] if host in self else default
+
+    def items(self):
+        return ((host, self[host]) for host in self)
+
+    def values(self):
+        return (self[host] for host in self)
 
 class Sshconf(object):
     CONFPATH_DEFAULT = Path.home() / ".ssh/config"
+    CACHEDIR_DEFAULT = Path.home() / ".cache/ocsh"
+    CACHE_FORMAT = 9
+    CACHE_BUCKETS = 64 # cache files holding Host lines of a single literal name, for configurations of more than CACHE_BUCKETS_MIN blocks
+    CACHE_BUCKETS_MIN = 1000
+    SYSCONF_PATH = Path("/etc/ssh/ssh_config") # not parsed, but affects resolved settings
 
-    def __init__(self, conf_path):
+    def __init__(self, conf_path, cache_dir=CACHEDIR_DEFAULT, rebuild=False, index_only=False):
+        """ if index_only is set, only the hosts index is loaded when its cache is valid, for fast completion """
         self.conf_path = conf_path
         self.main = dict()
-        self.hosts = dict()
-        self._load(conf_path)
+        self.hosts = dict() # Host or Match line -> [options and annotations of the block, with its 'position' in configuration], several for a repeated line
+        self.aliases = dict() # name -> [(position, Host line)] of Host lines holding several literal names
+        self.patterns = defaultdict(list) # literal prefix -> [(position, Host line)] of Host lines holding wildcard patterns
+        self.matchblocks = list() # [(position, Match line)]
+        self.lookups = dict() # name -> merged configuration, for this process
+        self.index = list() # sorted host names, without patterns
+        self.actions = dict() # host name -> post actions names
+        self.files = list() # all files of the Include closure, in load order
+        self.nblocks = 0
+        self.resolved = dict() # effective settings from 'ssh -G', per target
+        self.resolved_lock = threading.Lock()
+        self.resolved_changed = False # resolved settings are saved once at exit
+        self.stamps = list()
+        self.partial = False
+        self.reparsed = None # configuration parsed again when a cache bucket is missing
+        self.cache_path = None
+        self.index_path = None
+        self.resolved_path = None
+        if cache_dir:
+            key = hashlib.sha1(str(Path(conf_path).absolute()).encode()).hexdigest()[:16]
+            self.cache_path = Path(cache_dir) / ("sshconf-%s.pickle" % key)
+            self.index_path = Path(cache_dir) / ("hosts-%s.pickle" % key)
+            self.resolved_path = Path(cache_dir) / ("resolved-%s.pickle" % key)
+        with PROFILE.phase("load ssh_config"):
+            if index_only and not rebuild and self._index_load():
+                self.partial = True
+                return
+            if rebuild or not self._cache_load():
+                self._load(conf_path)
+                self._build_matcher()
+                self._build_index()
+                self._cache_save()
+
+    def expand(self, regex):
+        """ return host names matching regex, only testing names starting with its literal prefix """
+        self._index()
+        if '|' in regex:
+            prefix = ""
+        else:
+            prefix = re.match(r"[\w@%,/:=-]*", regex).group()
+            if regex[len(prefix):len(prefix)+1] in ('*', '?', '{'):
+                prefix = prefix[:-1] # last literal character is optional
+        names = self.index[bisect.bisect_left(self.index, prefix):]
+        return [name for name in itertools.takewhile(lambda n: n.startswith(prefix), names) if re.match(regex, name)]
+
+    def complete(self, word):
+        """ return completions for word, which is [user@]host or [user@]host[action,action """
+        self._index()
+        user, _, word = word.rpartition('@')
+        user = user + '@' if user else ""
+        if '[' in word:
+            host, _, actions = word.partition('[')
+            done, _, prefix = actions.rpartition(',')
+            done = done + ',' if done else ""
+            return ["%s%s[%s%s" % (user, host, done, action) for action in self.actions.get(host, list()) if action.startswith(prefix)]
+        names = self.index[bisect.bisect_left(self.index, word):]
+        return [user + name for name in itertools.takewhile(lambda n: n.startswith(word), names)]
+
+    def lookup(self, name):
+        """ return options and ocsh annotations applying to host name, merged from its Host and Match blocks in configuration order.
+        as in ssh_config(5), the first obtained value of each option, and of each post action, is used """
+        if name in self.lookups:
+            return self.lookups[name]
+        blocks = self._blocks(name, name)
+        if self.matchblocks:
+            # 'Match host' criteria apply to the host name after Hostname substitution
+            hostname = next((v for block in blocks for k, v in self._block(*block).items() if k.lower() == 'hostname'), name).replace('%h', name)
+            if hostname != name:
+                blocks = self._blocks(name, hostname)
+        conf = defaultdict(dict)
+        for block in blocks:
+            for option, value in self._block(*block).items():
+                if option == 'post':
+                    for action, post in value.items():
+                        conf['post'].setdefault(action, post)
+                elif option != 'position':
+                    conf.setdefault(option, value)
+        self.lookups[name] = conf
+        return conf
+
+    def _blocks(self, name, hostname):
+        """ return (position, line) of Host and Match blocks matching host name, in configuration order """
+        blocks = set(self.aliases.get(name, ()))
+        if name in self.hosts:
+            blocks.update((conf['position'], name) for conf in self.hosts[name])
+        for i in range(len(name) + 1):
+            for position, host in self.patterns.get(name[:i], ()):
+                if self._match_patterns(host.split(), name):
+                    blocks.add((position, host))
+        for position, match in self.matchblocks:
+            if self._match_criteria(match, name, hostname):
+                blocks.add((position, match))
+        return sorted(blocks)
+
+    def _block(self, position, line):
+        """ return options and annotations of the block of Host or Match line at position """
+        return next(conf for conf in self.hosts[line] if conf['position'] == position)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _glob(pattern):
+        return re.compile(re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".") + "$")
+
+    def _match_patterns(self, patterns, name):
+        """ ssh_config(5) patterns list matching: name must match a pattern, and none of the negated ones """
+        matched = False
+        for pattern in patterns:
+            if pattern.startswith('!'):
+                if self._glob(pattern[1:]).match(name):
+                    return False
+            elif not matched and self._glob(pattern).match(name):
+                matched = True
+        return matched
+
+    def _match_criteria(self, match, name, hostname):
+        """ return True if all criteria of Match line are met. only 'all', 'host', 'originalhost' and 'localuser' are supported,
+        blocks with other criteria never match """
+        words = match.split()[1:]
+        while words:
+            criteria = words.pop(0)
+            negated = criteria.startswith('!')
+            criteria = criteria.lstrip('!').lower()
+            if criteria == 'all':
+                result = True
+            elif criteria in ('host', 'originalhost', 'localuser') and words:
+                subject = { 'host': hostname, 'originalhost': name, 'localuser': os.environ.get('USER', "") }[criteria]
+                result = self._match_patterns(words.pop(0).split(','), subject)
+            else:
+                debug("ssh_config: unsupported criteria '%s', ignoring block %s" % (criteria, match))
+                return False
+            if result == negated:
+                return False
+        return True
+
+    def _build_matcher(self):
+        """ index blocks by the names they can apply to: Host lines of several literal names by name, Host lines holding
+        patterns by the literal prefix of each pattern, Match lines being always tested """
+        self.aliases = dict()
+        self.patterns = defaultdict(list)
+        self.matchblocks = list()
+        for host, confs in self.hosts.items():
+            for conf in confs:
+                if host.startswith("Match "):
+                    self.matchblocks.append((conf['position'], host))
+                    continue
+                names = host.split()
+                if not any(re.search(r"[*?!]", name) for name in names):
+                    if len(names) > 1:
+                        for name in names:
+                            self.aliases.setdefault(name, list()).append((conf['position'], host))
+                    continue
+                for prefix in {re.match(r"[^*?]*", name).group() for name in names if not name.startswith('!')}:
+                    self.patterns[prefix].append((conf['position'], host))
+        self.patterns = dict(self.patterns)
+
+    def _index(self):
+        if self.index is None and not self._index_load():
+            self._build_index()
+
+    def _build_index(self):
+        """ index host names, without patterns, and their post actions including those of matching pattern blocks """
+        names = set()
+        self.actions = dict()
+        for host in self.hosts:
+            if not host.startswith("Match "):
+                names.update(name for name in host.split() if not re.search(r"[*?!]", name))
+        for name in names:
+            single = name in self.hosts and len(self.hosts[name]) == 1 and name not in self.aliases
+            conf = self.hosts[name][0] if single and not self.patterns and not self.matchblocks else self.lookup(name)
+            if conf.get('post'):
+                self.actions[name] = sorted(conf['post'].keys())
+        self.index = sorted(names)
+
+    def resolve(self, target):
+        """return effective ssh settings of target as reported by 'ssh -G', with lowercase keys.
+        'ssh -G' is run at most once per target and configuration version"""
+        with self.resolved_lock:
+            if target in self.resolved:
+                return self.resolved[target]
+        cmd = ["ssh", "-G"]
+        if self.conf_path.exists():
+            cmd += ["-F", str(self.conf_path)]
+        with PROFILE.phase("ssh -G", target):
+            res = subprocess.run(cmd + [target], capture_output=True)
+        settings = dict()
+        for line in res.stdout.decode(errors='replace').split("\n"):
+            kv = line.split(' ', 1)
+            if len(kv) == 2 and kv[0] not in settings:
+                settings[kv[0]] = kv[1]
+        if res.returncode != 0:
+            debug("ssh -G %s failed: %s" % (target, res.stderr.decode(errors='replace').strip()))
+            return settings
+        with self.resolved_lock:
+            if not self.resolved_changed:
+                atexit.register(self._resolved_save)
+            self.resolved_changed = True
+            self.resolved[target] = settings
+        return settings
+
+    def _stamps(self, files):
+        stamps = list()
+        for f in files:
+            try:
+                st = f.stat()
+                stamps.append((str(f), st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamps.append((str(f), None, None))
+        return stamps
+
+    def _sysfiles(self):
+        """ files not parsed but affecting 'ssh -G': the system configuration, its Include files and the directories of globs """
+        files = [self.SYSCONF_PATH]
+        try:
+            text = self.SYSCONF_PATH.read_text()
+        except OSError:
+            return files
+        for m in re.finditer(r"^\s*Include\s+(.+)$", text, re.MULTILINE | re.IGNORECASE):
+            for pattern in m.group(1).split():
+                path = Path(os.path.expanduser(pattern))
+                if not path.is_absolute():
+                    path = self.SYSCONF_PATH.parent / path
+                if glob.has_magic(str(path)):
+                    files.append(path.parent)
+                    files += [Path(f) for f in sorted(glob.glob(str(path)))]
+                else:
+                    files.append(path)
+        return files
+
+    def _read(self, path):
+        if not path or not path.exists():
+            return None
+        try:
+            with path.open('rb') as f:
+                obj = pickle.load(f)
+        except Exception as e:
+            debug("could not read ssh_config cache %s: %s" % (path, e))
+            return None
+        return obj if obj.get('format') == self.CACHE_FORMAT else None
+
+    def _cache_load(self):
+        cache = self._read(self.cache_path)
+        if not cache:
+            return False
+        self.files = [Path(f) for f, _, _ in cache['stamps']]
+        self.stamps = self._stamps(self.files)
+        if self.stamps != cache['stamps']:
+            debug("ssh_config changed, rebuilding cache %s" % self.cache_path)
+            self.files = list()
+            return False
+        debug("using ssh_config cache %s" % self.cache_path)
+        self.main = cache['main']
+        self.hosts = Lazyhosts(cache['hosts'], cache['buckets'], lambda n: self._bucket_load(n, cache['build']))
+        self.aliases = cache['aliases']
+        self.patterns = cache['patterns']
+        self.matchblocks = cache['matchblocks']
+        self.index = None # loaded on first use from the index cache, which holds the same stamps
+        resolved = self._read(self.resolved_path)
+        if resolved and resolved['stamps'] == self.stamps and resolved['sysstamps'] == self._stamps(self._sysfiles()):
+            self.resolved = resolved['resolved']
+        return True
+
+    def _index_load(self):
+        index = self._read(self.index_path)
+        if not index or index['stamps'] != (self.stamps or self._stamps([Path(f) for f, _, _ in index['stamps']])):
+            return False
+        self.index = index['index']
+        self.actions = index['actions']
+        return True
+
+    def _cache_save(self):
+        if not self.cache_path:
+            return
+        self.stamps = self._stamps(self.files)
+        hosts = { host: pickle.dumps(conf, protocol=pickle.HIGHEST_PROTOCOL) for host, conf in self.hosts.items() }
+        nbuckets = self.CACHE_BUCKETS if len(hosts) > self.CACHE_BUCKETS_MIN else 0
+        build = os.urandom(8).hex() # buckets of another build are not used
+        if nbuckets:
+            buckets = [ dict() for _ in range(nbuckets) ]
+            for host in [h for h in hosts if not re.search(r"[\s*?!]", h)]:
+                buckets[Lazyhosts.bucket(host, nbuckets)][host] = hosts.pop(host)
+            for n, bucket in enumerate(buckets):
+                self._write(self._bucket_path(n), { 'format': self.CACHE_FORMAT, 'build': build, 'hosts': bucket })
+        self._write(self.cache_path, { 'format': self.CACHE_FORMAT, 'stamps': self.stamps, 'main': self.main, 'hosts': hosts,
+                    'buckets': nbuckets, 'build': build, 'aliases': self.aliases, 'patterns': self.patterns, 'matchblocks': self.matchblocks })
+        self._write(self.index_path, { 'format': self.CACHE_FORMAT, 'stamps': self.stamps, 'index': self.index, 'actions': self.actions })
+
+    def _bucket_path(self, n):
+        return self.cache_path.with_name("%s-%02d%s" % (self.cache_path.stem, n, self.cache_path.suffix))
+
+    def _bucket_load(self, n, build):
+        bucket = self._read(self._bucket_path(n))
+        if bucket and bucket['build'] == build:
+            return bucket['hosts']
+        # cache rebuilt by another process since ours was read
+        debug("ssh_config cache bucket %s missing, parsing configuration" % self._bucket_path(n))
+        if self.reparsed is None:
+            self.reparsed = Sshconf(self.conf_path, cache_dir=None)
+        return { host: pickle.dumps(confs, protocol=pickle.HIGHEST_PROTOCOL) for host, confs in self.reparsed.hosts.items()
+                 if not re.search(r"[\s*?!]", host) and Lazyhosts.bucket(host, self.hosts.nbuckets) == n }
+
+    def _resolved_save(self):
+        with self.resolved_lock:
+            if not self.resolved_path or self.partial or not self.resolved_changed:
+                return
+            resolved = dict(self.resolved)
+            self.resolved_changed = False
+        self._write(self.resolved_path, { 'format': self.CACHE_FORMAT, 'stamps': self.stamps, 'sysstamps': self._stamps(self._sysfiles()),
+                    'resolved': resolved })
+
+    def _write(self, path, obj):
+        try:
+            write_atomic(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError as e:
+            debug("could not write ssh_config cache %s: %s" % (path, e))
 
     def _load(self, conf_path):
+        self.files.append(conf_path)
         if not conf_path.exists():
             return
 
-        current = "main"
+        current, block = "main", None
         for numline, line in enumerate(conf_path.read_text().split("\n")):
             line = line.strip()
             if not line:
@@ -118,20 +689,40 @@ class Sshconf(object):
                             continue
                     m = re.match(r"ocsh(?:\s*=\s*|\s+)cmd(?:\s*=\s*|\s+)(?P<cmd>.+)", cline)
                     if m:
-                        self.hosts[current]['cmd'] = m['cmd']
+                        block['cmd'] = m['cmd']
+                        continue
+                    m = re.match(r"ocsh(?:\s*=\s*|\s+)master(?:(?:\s*=\s*|\s+)(?P<persist>\S+))?$", cline)
+                    if m:
+                        block['master'] = m['persist'] or Octossh.MASTER_PERSIST_DEFAULT
+                        continue
+                    m = re.match(r"ocsh(?:\s*=\s*|\s+)(?P<option>prompt|passprompt)(?:\s*=\s*|\s+)(?P<regex>.+)", cline)
+                    if m:
+                        block[m['option']] = m['regex'].strip('"')
+                        continue
+                    m = re.match(r"ocsh(?:\s*=\s*|\s+)posttimeout(?:\s*=\s*|\s+)(?P<timeout>[\d.]+)$", cline)
+                    if m:
+                        block['posttimeout'] = m['timeout']
+                        continue
+                    m = re.match(r"ocsh(?:\s*=\s*|\s+)alt(?:\s*=\s*|\s+)(?P<route>(?:(?:jump|hostname)=\S+\s*)+)$", cline)
+                    if m:
+                        block.setdefault('alt', list()).append(dict(kv.split('=', 1) for kv in m['route'].split()))
+                        continue
+                    m = re.match(r"ocsh(?:\s*=\s*|\s+)login(?:\s*=\s*|\s+)(?P<login>\w+)$", cline)
+                    if m:
+                        block['login'] = m['login']
                         continue
                     m = re.match(r"ocsh(?:\s*=\s*|\s+)pre(?:\s*=\s*|\s+)(?P<pre>.+)", cline)
                     if m:
-                        self.hosts[current]['pre'] = m['pre']
+                        block['pre'] = m['pre']
                         continue
                     m = re.match(r"ocsh(?:\s*=\s*|\s+)pass(?:\s*=\s*|\s+)(?P<passname>.+)", cline)
                     if m:
-                        self.hosts[current]['pass'] = m['passname']
+                        block['pass'] = m['passname']
                         continue
                     m = re.match(r"ocsh(?:\s*=\s*|\s+)post(?:\s*=\s*|\s+)(?P<action>[\w\_-]+)(?:\s*=\s*|\s+)(?P<cmd>.+)", cline)
                     if m:
                         cmd = m['cmd'].strip('"')
-                        self.hosts[current]['post'][m['action']] = [cmd, None]
+                        block['post'][m['action']] = [cmd, None]
                         continue
                     m = re.match(r"ocsh(?:\s*=\s*|\s+)postpass(?:\s*=\s*|\s+)(?P<action>[\w\_-]+)(?:\s*=\s*|\s+)(?P<arg>.+)", cline)
                     if m:
@@ -139,7 +730,7 @@ class Sshconf(object):
                         if len(r) == 2:
                             cmd = r[0].strip('"')
                             passname = r[1].strip('"')
-                            self.hosts[current]['post'][m['action']] = [cmd, passname]
+                            block['post'][m['action']] = [cmd, passname]
                             continue
                     self._warn("could not parse ocsh annotation", current, numline, line)
                 continue
@@ -147,33 +738,517 @@ class Sshconf(object):
             # parse normal line
             m = re.match(r"(?P<option>\w+)(?:\s*=\s*|\s+)(?P<arg>.+)", line)
             if m:
-                if m['option'] == 'Host':
-                    current = m['arg']
-                    self.hosts[current] = defaultdict(dict)
+                if m['option'] in ('Host', 'Match'):
+                    current = m['arg'] if m['option'] == 'Host' else "Match " + m['arg']
+                    block = defaultdict(dict)
+                    block['position'] = self.nblocks
+                    self.hosts.setdefault(current, list()).append(block)
+                    self.nblocks += 1
                 else:
                     if m['option'] == "Include":
-                        self._load(Path(m['arg']))
+                        for pattern in m['arg'].split():
+                            self._include(pattern)
                     elif current == "main":
                         self.main[m['option']] = m['arg']
                     else:
-                        self.hosts[current][m['option']] = m['arg']
+                        block[m['option']] = m['arg']
                 continue
             self._warn("could not parse line", current, numline, line)
 
+    def _include(self, pattern):
+        """ load files of an Include pattern, expanding '~' and globs, relative paths being in ~/.ssh as for ssh(1).
+        the directory holding glob matches is also stamped, so that added or removed files invalidate the cache """
+        path = Path(os.path.expanduser(pattern))
+        if not path.is_absolute():
+            path = self.CONFPATH_DEFAULT.parent / path
+        if not glob.has_magic(str(path)):
+            self._load(path)
+            return
+        parent = path.parent
+        while glob.has_magic(str(parent)):
+            parent = parent.parent
+        self.files.append(parent)
+        for f in sorted(glob.glob(str(path))):
+            self._load(Path(f))
+
     def _warn(self, text, current, numline, line):
         warning("warning: ssh_config:%d %s%s: %s" % (numline, text, "" if current == "main" else " in Host %s" % current,  line))
         
 
+class Knownhosts(object):
+    """ known_hosts(5) files loaded once per run, answering whether a host has a key in memory.
+    supports hashed entries, [host]:port names, wildcard and negated patterns, and markers.
+    parsed entries of each file are cached in cache_dir until the file changes """
+    cache = dict() # tuple of paths -> Knownhosts
+    cache_lock = threading.Lock()
+    CACHE_FORMAT = 1
+
+    def __init__(self, paths, cache_dir=Sshconf.CACHEDIR_DEFAULT):
+        self.names = set()
+        self.patterns = list() # (positive regexes, negative regexes) of entries using wildcards or negation
+        self.hashed = defaultdict(set) # salt -> HMAC-SHA1 of host names
+        for path in paths:
+            with PROFILE.phase("load known_hosts"):
+                self._load_cached(Path(path).expanduser(), cache_dir)
+
+    @classmethod
+    def load(cls, paths):
+        key = tuple(paths)
+        with cls.cache_lock:
+            if key not in cls.cache:
+                cls.cache[key] = cls(paths)
+            return cls.cache[key]
+
+    def contains(self, name):
+        import hmac
+        name = name.lower()
+        if name in self.names:
+            return True
+        for positives, negatives in self.patterns:
+            if any(r.match(name) for r in positives) and not any(r.match(name) for r in negatives):
+                return True
+        for salt, hashes in self.hashed.items():
+            if hmac.digest(salt, name.encode(), 'sha1') in hashes:
+                return True
+        return False
+
+    def _load_cached(self, path, cache_dir):
+        if '%' in str(path) or not path.exists():
+            return
+        if not cache_dir:
+            self._load(path)
+            return
+        cache_path = Path(cache_dir) / ("knownhosts-%s.pickle" % hashlib.sha1(str(path.absolute()).encode()).hexdigest()[:16])
+        st = path.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+        try:
+            with cache_path.open('rb') as f:
+                cache = pickle.load(f)
+        except Exception:
+            cache = None
+        if not cache or cache.get('format') != self.CACHE_FORMAT or cache.get('stamp') != stamp:
+            part = Knownhosts([], cache_dir=None)
+            part._load(path)
+            cache = {'format': self.CACHE_FORMAT, 'stamp': stamp, 'names': part.names, 'patterns': part.patterns, 'hashed': dict(part.hashed)}
+            try:
+                write_atomic(cache_path, pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL))
+            except OSError as e:
+                debug("could not write known_hosts cache %s: %s" % (cache_path, e))
+        if self.names:
+            self.names.update(cache['names'])
+        else:
+            self.names = cache['names']
+        self.patterns += cache['patterns']
+        for salt, hashes in cache['hashed'].items():
+            self.hashed[salt].update(hashes)
+
+    def _load(self, path):
+        import base64
+        for line in path.read_text(errors='replace').split("\n"):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if fields[0].startswith('@'):
+                if fields[0] == "@revoked":
+                    continue
+                fields = fields[1:] # @cert-authority: hosts with a key signed by this CA are known
+            if not fields:
+                continue
+            hosts = fields[0]
+            if hosts.startswith("|1|"):
+                try:
+                    _, _, salt, digest = hosts.split('|')
+                    self.hashed[base64.b64decode(salt)].add(base64.b64decode(digest))
+                except ValueError:
+                    debug("known_hosts %s: invalid hashed entry %s" % (path, hosts))
+                continue
+            patterns = hosts.lower().split(',')
+            if not any(c in hosts for c in "*?!"):
+                self.names.update(patterns)
+                continue
+            positives, negatives = list(), list()
+            for pattern in patterns:
+                negated = pattern.startswith('!')
+                regex = re.compile(re.escape(pattern.lstrip('!')).replace(r"\*", ".*").replace(r"\?", ".") + "$")
+                (negatives if negated else positives).append(regex)
+            self.patterns.append((positives, negatives))
+
+class Unixservice(object):
+    """ service of ocsh processes of the same user over a Unix socket, run in the foreground by serve().
+    messages are JSON lines, one request and one answer per connection. subclasses implement _handle() """
+    NAME = None
+    SOCK_ENV = None
+    SOCKPATH_DEFAULT = None
+
+    def __init__(self, sock_path=None):
+        self.sock_path = Path(sock_path or self.sockpath())
+        self.lock = threading.Lock()
+
+    @classmethod
+    def sockpath(cls):
+        return Path(os.environ.get(cls.SOCK_ENV, cls.SOCKPATH_DEFAULT))
+
+    @classmethod
+    def request(cls, msg, timeout=5):
+        """ send msg to the running service and return its answer, or None if it is not running """
+        sock_path = cls.sockpath()
+        if not sock_path.exists():
+            return None
+        import socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.settimeout(timeout)
+                s.connect(str(sock_path))
+                s.sendall(json.dumps(msg).encode() + b"\n")
+                return json.loads(s.makefile('rb').readline())
+        except (OSError, ValueError) as e:
+            debug("%s %s not reachable: %s" % (cls.NAME, sock_path, e))
+            return None
+
+    @classmethod
+    def running(cls):
+        return cls.request({'op': 'ping'}) is not None
+
+    def serve(self):
+        import socket, struct, socketserver
+        service = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+                if struct.unpack('3i', creds)[1] != os.getuid():
+                    warning("%s: rejecting connection from uid %d" % (service.NAME, struct.unpack('3i', creds)[1]))
+                    return
+                try:
+                    msg = json.loads(self.rfile.readline())
+                except ValueError:
+                    return
+                self.wfile.write(json.dumps(service._handle(msg)).encode() + b"\n")
+
+        self.sock_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.sock_path.exists():
+            if self.running():
+                raise OcshError("%s already running on %s" % (self.NAME, self.sock_path))
+            self.sock_path.unlink()
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(self.sock_path), Handler)
+            server.daemon_threads = True
+        finally:
+            os.umask(umask)
+        info("%s listening on %s, %s" % (self.NAME, self.sock_path, self._describe()))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.sock_path.unlink()
+            self._shutdown()
+
+    def _describe(self):
+        return ""
+
+    def _shutdown(self):
+        pass
+
+    def _handle(self, msg):
+        raise NotImplementedError()
+
+class Passagent(Unixservice):
+    """ keeps secrets read from pass(1) in memory, and serves them over a Unix socket to ocsh processes of the same user.
+    messages are JSON lines: {"op": "get"|"put"|"flush"|"ping", "name": <pass-name>, "secret": <secret>} """
+    NAME = "agent"
+    SOCK_ENV = 'OCSH_AGENT_SOCK'
+    SOCKPATH_DEFAULT = Path(os.environ['XDG_RUNTIME_DIR']) / "ocsh-agent.sock" if 'XDG_RUNTIME_DIR' in os.environ else Sshconf.CACHEDIR_DEFAULT / "agent.sock"
+    TTL_DEFAULT = 3600
+    MAX_ENTRIES_DEFAULT = 100
+
+    def __init__(self, sock_path=None, ttl=TTL_DEFAULT, max_entries=MAX_ENTRIES_DEFAULT):
+        super().__init__(sock_path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.secrets = OrderedDict() # name -> (secret, expiry), least recently used first
+
+    @classmethod
+    def get(cls, name):
+        res = cls.request({'op': 'get', 'name': name})
+        return res.get('secret') if res else None
+
+    @classmethod
+    def put(cls, name, secret):
+        cls.request({'op': 'put', 'name': name, 'secret': secret})
+
+    @classmethod
+    def flush(cls):
+        return cls.request({'op': 'flush'})
+
+    def _describe(self):
+        return "ttl %ds, max %d entries" % (self.ttl, self.max_entries)
+
+    def _handle(self, msg):
+        now = time.monotonic()
+        with self.lock:
+            for name in [n for n, (_, expiry) in self.secrets.items() if expiry < now]:
+                del self.secrets[name]
+            if msg.get('op') == 'get':
+                if msg.get('name') not in self.secrets:
+                    return {'secret': None}
+                self.secrets.move_to_end(msg['name'])
+                return {'secret': self.secrets[msg['name']][0]}
+            elif msg.get('op') == 'put':
+                self.secrets[msg['name']] = (msg['secret'], now + self.ttl)
+                self.secrets.move_to_end(msg['name'])
+                while len(self.secrets) > self.max_entries:
+                    self.secrets.popitem(last=False)
+                return {}
+            elif msg.get('op') == 'flush':
+                count = len(self.secrets)
+                self.secrets.clear()
+                return {'flushed': count}
+            elif msg.get('op') == 'ping':
+                return {}
+        return {'error': "invalid request"}
+
+class Session(object):
+    """ shell of a logged-in connection, running commands one after the other and collecting exit code, output and duration.
+    the shell echo and prompts are disabled, and each command output is delimited by markers holding a random token """
+    COMMAND_TIMEOUT_DEFAULT = 600
+    SETUP_TIMEOUT = 10
+
+    def __init__(self, p, target):
+        self.p = p
+        self.target = target
+        self.token = os.urandom(8).hex()
+        self.lock = threading.Lock()
+        self.alive = True
+        # markers are printed by split printf arguments, so they never appear in the echo of the commands sent
+        self.p.sendline("stty -echo 2>/dev/null; PS1=''; PS2=''; unset PROMPT_COMMAND; printf '%s_%s\\n' __OCSH READY_" + self.token)
+        if self._expect(r"__OCSH_READY_%s\r?\n" % self.token, self.SETUP_TIMEOUT) is None:
+            self.close()
+            raise OcshError("session: shell of host %s not ready" % self.target)
+
+    def _expect(self, pattern, timeout):
+        """return output before pattern, or None on timeout or connection closed"""
+        import pexpect
+        if self.p.expect([pattern, pexpect.EOF, pexpect.TIMEOUT], timeout=timeout) != 0:
+            return None
+        return self.p.before.replace(b"\r\n", b"\n").decode(errors='replace')
+
+    def run(self, command, timeout=COMMAND_TIMEOUT_DEFAULT):
+        """run command in the shell and return its result as a dict, with exit None if command timed out or connection closed"""
+        with self.lock:
+            start = time.monotonic()
+            if not self.alive:
+                return {'command': command, 'exit': None, 'stdout': "", 'stderr': "", 'duration': 0}
+            # command runs in a subshell with stdin closed, so that it can neither exit the session shell nor consume the commands sent after it
+            self.p.sendline("__oe=$(mktemp); ( %s\n) </dev/null 2>\"$__oe\"; __rc=$?; printf '%%s_%%s\\n' __OCSH OUT_%s; "
+                            "cat \"$__oe\"; rm -f \"$__oe\"; printf '%%s_%%s_%%d\\n' __OCSH END_%s $__rc" % (command, self.token, self.token))
+            with PROFILE.phase("batch", self.target):
+                stdout = self._expect(r"__OCSH_OUT_%s\r?\n" % self.token, timeout)
+                stderr = self._expect(r"__OCSH_END_%s_(\d+)\r?\n" % self.token, timeout) if stdout is not None else None
+            result = {
+                'command': command,
+                'exit': int(self.p.match.group(1)) if stderr is not None else None,
+                'stdout': stdout or "",
+                'stderr': stderr or "",
+                'duration': round(time.monotonic() - start, 3),
+            }
+            if result['exit'] is None:
+                # output of the shell cannot be delimited anymore
+                warning("session: no result from host %s for command, closing session: %s" % (self.target, command))
+                self.close()
+            return result
+
+    async def run_async(self, command, timeout=COMMAND_TIMEOUT_DEFAULT):
+        """run() without blocking the event loop"""
+        import asyncio
+        return await asyncio.to_thread(self.run, command, timeout)
+
+    def close(self):
+        self.alive = False
+        self.p.close(force=True)
+
+class Sessionbroker(Unixservice):
+    """ keeps shells of logged-in connections with post actions, such as root shells after 'su', and runs commands of ocsh processes
+    of the same user on them. sessions are closed after being idle for some time, and at most max_per_host are opened per destination.
+    messages are JSON lines: {"op": "run"|"list"|"close"|"flush"|"ping", "conf": <ssh_config>, "destination": <host[action]>, "command": <cmd>, ...} """
+    NAME = "broker"
+    SOCK_ENV = 'OCSH_BROKER_SOCK'
+    SOCKPATH_DEFAULT = Path(os.environ['XDG_RUNTIME_DIR']) / "ocsh-broker.sock" if 'XDG_RUNTIME_DIR' in os.environ else Sshconf.CACHEDIR_DEFAULT / "broker.sock"
+    IDLE_DEFAULT = 600
+    MAX_PER_HOST_DEFAULT = 2
+
+    def __init__(self, sock_path=None, idle=IDLE_DEFAULT, max_per_host=MAX_PER_HOST_DEFAULT):
+        super().__init__(sock_path)
+        self.idle = idle
+        self.max_per_host = max_per_host
+        self.sessions = defaultdict(list) # key -> idle sessions
+        self.slots = dict() # key -> semaphore limiting sessions of the key
+        self.last = dict() # session -> monotonic time of last use
+
+    @classmethod
+    def run(cls, conf_path, destination, command, timeout=None, jumphosts=None, ssh_options=None, login=None):
+        """ run command on a brokered session and return its result, or None if no broker is running """
+        return cls.request({'op': 'run', 'conf': str(conf_path) if conf_path else None, 'destination': destination, 'command': command,
+                            'timeout': timeout, 'jumphosts': jumphosts, 'ssh_options': ssh_options, 'login': login}, timeout=None)
+
+    def serve(self):
+        threading.Thread(target=self._evict, daemon=True).start()
+        super().serve()
+
+    def _describe(self):
+        return "idle %ds, max %d sessions per host" % (self.idle, self.max_per_host)
+
+    def _evict(self):
+        while True:
+            time.sleep(max(1, min(self.idle, 10)))
+            now = time.monotonic()
+            with self.lock:
+                expired = [(key, se) for key, sessions in self.sessions.items() for se in sessions if self.last[se] + self.idle < now]
+                for key, se in expired:
+                    self.sessions[key].remove(se)
+                    del self.last[se]
+            for key, se in expired:
+                info("broker: closing idle session to %s" % se.target)
+                se.close()
+
+    def _shutdown(self):
+        with self.lock:
+            for sessions in self.sessions.values():
+                for se in sessions:
+                    se.close()
+            self.sessions.clear()
+
+    def _handle(self, msg):
+        if msg.get('op') == 'ping':
+            return {}
+        elif msg.get('op') == 'list':
+            with self.lock:
+                return {'sessions': [{'destination': key[1], 'conf': key[0], 'idle': round(time.monotonic() - self.last[se])}
+                                     for key, sessions in self.sessions.items() for se in sessions]}
+        elif msg.get('op') == 'close':
+            with self.lock:
+                closed = [se for key in list(self.sessions) if (msg.get('pattern') or "") in key[1] for se in self.sessions.pop(key)]
+                for se in closed:
+                    del self.last[se]
+            for se in closed:
+                se.close()
+            return {'closed': len(closed)}
+        elif msg.get('op') == 'flush':
+            return {'flushed': Octossh.flush_secrets()}
+        elif msg.get('op') == 'run':
+            try:
+                return self._run(msg)
+            except OcshError as e:
+                return {'error': str(e)}
+        return {'error': "invalid request"}
+
+    def _run(self, msg):
+        key = (msg.get('conf'), msg['destination'], msg.get('jumphosts'), tuple(msg.get('ssh_options') or ()), msg.get('login'))
+        with self.lock:
+            slots = self.slots.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+        with slots:
+            with self.lock:
+                se = self.sessions[key].pop() if self.sessions[key] else None
+                self.last.pop(se, None)
+            if se is None:
+                info("broker: opening session to %s" % msg['destination'])
+                conf = Sshconf(Path(msg['conf']) if msg.get('conf') else Sshconf.CONFPATH_DEFAULT)
+                se = Octossh(conf, msg['destination'], msg.get('jumphosts'), None, msg.get('ssh_options'), msg.get('login')).session()
+            result = se.run(msg['command'], msg.get('timeout') or Session.COMMAND_TIMEOUT_DEFAULT)
+            if se.alive:
+                with self.lock:
+                    self.sessions[key].append(se)
+                    self.last[se] = time.monotonic()
+        return result
+
+class Jsonoutput(object):
+    """ writes output of connections as JSON lines records {"host", "stream": "stdout"|"stderr", "ts", "data"} as it arrives,
+    then a final record {"host", "stream": "exit", "ts", "exit", "duration", "timings", "bytes", "dropped", "spilled"} per host.
+    output of a host from the first chunk going beyond max_bytes is written to files in spill_dir if set, otherwise dropped """
+    MAX_BYTES_DEFAULT = 1 << 20
+    CHUNK_SIZE = 65536 # records hold one line of output, or a chunk of a longer line
+
+    def __init__(self, out=sys.stdout, max_bytes=MAX_BYTES_DEFAULT, spill_dir=None):
+        self.out = out
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.lock = threading.Lock()
+        self.hosts = defaultdict(lambda: {'bytes': 0, 'dropped': 0, 'spilled': dict()})
+        self.overflowed = set() # hosts whose output went beyond max_bytes, so that smaller chunks after are not written out of order
+
+    def write(self, host, stream, data):
+        with self.lock:
+            state = self.hosts[host]
+            if host not in self.overflowed and state['bytes'] + len(data) <= self.max_bytes:
+                state['bytes'] += len(data)
+                self._record({'host': host, 'stream': stream, 'ts': time.time(), 'data': data.decode(errors='replace')})
+            elif self.spill_dir:
+                self.overflowed.add(host)
+                if stream not in state['spilled']:
+                    self.spill_dir.mkdir(parents=True, exist_ok=True)
+                    state['spilled'][stream] = str(self.spill_dir / ("%s.%s" % (re.sub(r"[^\w.@-]", "_", host), stream)))
+                with open(state['spilled'][stream], 'ab') as f:
+                    f.write(data)
+            else:
+                self.overflowed.add(host)
+                state['dropped'] += len(data)
+
+    def close(self, host, rc, duration, timings=None):
+        with self.lock:
+            self.overflowed.discard(host)
+            state = self.hosts.pop(host, None) or self.hosts.default_factory()
+            self._record({'host': host, 'stream': "exit", 'ts': time.time(), 'exit': rc, 'duration': round(duration, 3),
+                          'timings': {name: round(d, 3) for name, d in (timings or {}).items()}, **state})
+
+    def _record(self, record):
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+
 class Octossh(object):
     AUTOCOMPLETION = """_ocsh()
 {
     local cur prev words cword
     _init_completion -n : || return
     _expand || return
-    [[ $cur == @(*/|[.~])* ]] || _known_hosts_real -c -a -- "$cur"
+    [[ $cur == @(*/|[.~])* ]] || COMPREPLY=( $(ocsh --ocsh-complete "$cur" 2>/dev/null) )
 } && complete -F _ocsh -o nospace ocsh
 """
 
+    LOGIN_EXPECT = [
+        "(?i)are you sure you want to continue connecting",
+        r"(?i)(?:password[^\n:]*:)|(?:passphrase for key)",
+        "(?i)permission denied",
+        None, # shell prompt, PROMPT_DEFAULT or from '# ocsh prompt' annotation
+        # pexpect.EOF and pexpect.TIMEOUT, appended in _login()
+    ]
+    LOGIN_EXPECT_0_ARE_YOU_SURE = 0
+    LOGIN_EXPECT_1_PASSWORD = 1
+    LOGIN_EXPECT_2_PERMISSION_DENIED = 2
+    LOGIN_EXPECT_3_SHELL = 3
+    LOGIN_EXPECT_4_EOF = 4
+    LOGIN_EXPECT_5_TIMEOUT = 5
+    LOGIN_TIMEOUT = 10
+    LOGINS = ["sshpass", "pexpect"]
+    HANDOFF_READ_SIZE = 65536
+    PROMPT_DEFAULT = r"[#$>] ?$"
+    PASSPROMPT_DEFAULT = r"[Pp]assword[^:]*:"
+    POST_TIMEOUT_DEFAULT = 10
+    POST_TIMEOUT_FACTOR = 4 # learned timeout is this factor times the slowest recent duration
+    POST_TIMES_PATH = Sshconf.CACHEDIR_DEFAULT / "posttimes.json"
+    POST_TIMES_KEEP = 10
+    MASTERS_DIR = Sshconf.CACHEDIR_DEFAULT / "masters"
+    MASTERS_NAMES_PATH = Sshconf.CACHEDIR_DEFAULT / "masters.json" # destinations using masters, sockets being named by the %C hash
+    MASTER_PERSIST_DEFAULT = "10m"
+    ROUTE_TIMEOUT = 5 # seconds for a route to get the SSH banner of the target
+    ROUTE_DELAY = 0.25 # seconds before trying the next route while previous ones did not answer, as RFC 8305 happy eyeballs
+    UNREACHABLE_PATH = Sshconf.CACHEDIR_DEFAULT / "unreachable.json"
+    UNREACHABLE_TTL = 60 # seconds during which a route that did not answer is skipped
+    secrets = dict() # pass-name -> (secret, expiry), shared by all connections of this process
+    secrets_lock = threading.Lock()
+    SECRETS_TTL = Passagent.TTL_DEFAULT # seconds during which a secret is kept by this process, as by the agent
+
     @classmethod
     def install_bash_completion(cls):
         f = Path.home() / ".bash_completion"
@@ -188,133 +1263,835 @@ class Octossh(object):
         f.write_text(s)
         print("_ocsh autocompletion function added to %s" % f)
 
-    def __init__(self, conf, destination, jumphosts=None, args=None, ssh_options=None):
-        if shutil.which('ssh') is None:
+    @classmethod
+    def _masters(cls):
+        """return (socket, name) of master connections, name being the destinations using it as resolved by ssh -G"""
+        if not cls.MASTERS_DIR.exists():
+            return []
+        try:
+            destinations = json.loads(cls.MASTERS_NAMES_PATH.read_text())
+        except (OSError, ValueError):
+            destinations = dict()
+        names = defaultdict(list)
+        for dest, conf_path in destinations.items():
+            cmd = ["ssh", "-G", "-o", "ControlPath=%s/%%C" % cls.MASTERS_DIR] + (["-F", conf_path] if conf_path else []) + [dest]
+            res = subprocess.run(cmd, capture_output=True)
+            for line in res.stdout.decode(errors='replace').split('\n'):
+                if line.startswith("controlpath "):
+                    names[line.split(' ', 1)[1]].append(dest)
+        return [ (sock, ','.join(names.get(str(sock), [sock.name]))) for sock in sorted(cls.MASTERS_DIR.iterdir()) if sock.is_socket() ]
+
+    def _masters_record(self, target):
+        conf_path = str(Path(self.conf.conf_path).absolute()) if self.conf.conf_path else None
+        try:
+            destinations = json.loads(self.MASTERS_NAMES_PATH.read_text())
+        except (OSError, ValueError):
+            destinations = dict()
+        if target in destinations and destinations[target] == conf_path:
+            return
+        destinations[target] = conf_path
+        try:
+            write_atomic(self.MASTERS_NAMES_PATH, json.dumps(destinations).encode())
+        except OSError as e:
+            debug("could not save master destinations to %s: %s" % (self.MASTERS_NAMES_PATH, e))
+
+    @classmethod
+    def list_masters(cls):
+        for sock, name in cls._masters():
+            res = subprocess.run(["ssh", "-o", "ControlPath=%s" % sock, "-O", "check", "ocsh"], capture_output=True)
+            print("%s : %s" % (name, res.stderr.decode(errors='replace').strip() if res.returncode == 0 else "dead"))
+
+    @classmethod
+    def close_masters(cls, pattern=""):
+        """close master connections whose destination name contains pattern"""
+        for sock, name in cls._masters():
+            if pattern not in name:
+                continue
+            res = subprocess.run(["ssh", "-o", "ControlPath=%s" % sock, "-O", "exit", "ocsh"], capture_output=True)
+            if res.returncode != 0:
+                sock.unlink(missing_ok=True)
+            print("%s : closed" % name)
+
+    @classmethod
+    def list_sessions(cls):
+        res = Sessionbroker.request({'op': 'list'})
+        if res is None:
+            raise OcshError("no session broker running on %s" % Sessionbroker.sockpath())
+        for se in res['sessions']:
+            print("%s : idle %ds (%s)" % (se['destination'], se['idle'], se['conf'] or Sshconf.CONFPATH_DEFAULT))
+
+    @classmethod
+    def close_sessions(cls, pattern=""):
+        """close brokered sessions whose destination contains pattern"""
+        res = Sessionbroker.request({'op': 'close', 'pattern': pattern})
+        if res is None:
+            raise OcshError("no session broker running on %s" % Sessionbroker.sockpath())
+        print("closed %d sessions" % res['closed'])
+
+    @classmethod
+    def check_host_keys(cls, octosshs, workers=16):
+        """exit with an error listing all targets whose host key is missing from known_hosts, before any connection"""
+        check = lambda o: 'pass' not in o.conf or o.host_key_known()
+        if len(octosshs) == 1:
+            known = [check(octosshs[0])]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                known = list(pool.map(check, octosshs))
+        missing = [o.ssh_target for o, k in zip(octosshs, known) if not k]
+        if missing:
+            octosshs[0]._err("fingerprints of SSH hosts not found: %s !\nUse normal ssh(1) to accept the keys, or StrictHostKeyChecking in ssh_config(5)" % ', '.join(missing))
+
+    @classmethod
+    def run_parallel(cls, octosshs, workers, timeout=None, pretend=False, output=None):
+        """run connections on a pool of workers, prefixing output lines with host name, and print a summary of exit codes.
+        if output is set, output and exit codes are written to this Jsonoutput instead"""
+        for o in octosshs:
+            if o.post and not o.brokered:
+                raise o._err("cannot use post actions in parallel mode, unless a session broker is running (--ocsh-broker)")
+        lock = threading.Lock()
+        width = max(len(o.destination) for o in octosshs)
+
+        def _run(o):
+            prefix = "[%s] " % o.destination.ljust(width)
+            timings = dict()
+            PROFILE.timings.set(timings)
+            start = time.monotonic()
+            try:
+                rc = 0 if pretend else o.run(timeout=timeout, prefix=prefix, lock=lock, output=output)
+            except OcshError as e:
+                if output:
+                    output.write(o.destination, "stderr", ("error: %s\n" % e).encode())
+                else:
+                    with lock:
+                        error("error: %s%s" % (prefix, e))
+                rc = 1
+            if output:
+                output.close(o.destination, rc, time.monotonic() - start, timings)
+            return rc
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_run, octosshs))
+
+        failed = [o for o, rc in zip(octosshs, results) if rc != 0]
+        if output:
+            return 1 if failed else 0
+        print("[+] summary : %d hosts, %d ok, %d failed" % (len(octosshs), len(octosshs) - len(failed), len(failed)))
+        for o, rc in zip(octosshs, results):
+            print("    %s : %s" % (o.destination.ljust(width), "timeout" if rc is None else rc))
+        return 1 if failed else 0
+
+    def __init__(self, conf, destination, jumphosts=None, args=None, ssh_options=None, login=None):
+        if which('ssh') is None:
             raise self._err("you must install 'ssh'")
         self.conf = conf
-        self.prog = str(Path(sys.argv[0]))
+        self.sshconf = conf
+        # command re-invoking ocsh, also when used as a library where sys.argv[0] is the program importing it
+        self.prog = "{} {}".format(shlex.quote(sys.executable), shlex.quote(str(Path(__file__).resolve())))
         if self.conf.conf_path:
             self.prog += " -F %s" % self.conf.conf_path
 
+        self.destination = destination
         ssh_cmd, ssh_target, post, conf = self._get_target_cmd(destination)
         debug(f"destination={destination} args={args} ssh_cmd={ssh_cmd} ssh_target={ssh_target} post={post} conf={conf}")
 
+        # commands after post actions are run on a shell kept by the session broker
+        self.brokered = len(post.keys()) > 0 and bool(args) and Sessionbroker.running()
         if len(post.keys()) > 0:
-            if args:
-                raise self._err("cannot use post actions in when command is provided")
-            if not os.isatty(sys.stdout.fileno()):
-                raise self._err("cannot use post actions in non-interactive shell")
+            if args and not self.brokered:
+                raise self._err("cannot use post actions in when command is provided, unless a session broker is running (--ocsh-broker)")
 
-        # construct imbricated proxycommand SSH commands for all target
+        # jump hosts chain, resolved and authenticated by this process in run()
+        self.jumps = list()
+        # routes are probed only when ssh would reach the host by itself, the probe cannot reproduce pre, cmd or ssh options
+        self.probeable = not ('pre' in conf or 'cmd' in conf or ssh_options)
+        self.race = 'alt' in conf and self.probeable # also set by --ocsh-probe, see main()
+        if 'alt' in conf and not self.probeable:
+            warning("warning: ignoring alt routes of %s, its connection uses pre, cmd or ssh options" % destination)
         if jumphosts:
-            self._err("-J support not implemented")
-            # XXX TODO implement jump host properly
-            jump_list = jumphosts.split(',')
-            cmd = ""
-            for idx, host in enumerate(jump_list):
-                cmd = "ssh -o ProxyCommand=\"{} -W %h:%p {}\"".format(cmd.replace("\"", "\\\""), host)
-            ssh_cmd = "{} -o ProxyCommand=\"{}\"".format(ssh_cmd, cmd)
-            #cmd = ""
-            #for idx, target in enumerate(targets_list):
-            #    ssh_cmd, ssh_target, post = self._get_target_cmd(target)
-            #    if ssh_options and idx == len(targets_list) - 1: # insert provided ssh_options only for first-level command, meaning last target
-            #        ssh_cmd = ssh_cmd + ' ' + ' '.join(ssh_options)
-            #        ssh_options = None
-            #    if len(cmd) > 0:
-            #        cmd = "{} -o ProxyCommand=\"{} -W %h:%p\" {}".format(ssh_cmd, cmd.replace("\"", "\\\""), ssh_target)
-            #    else:
-            #        cmd = "{} {}".format(ssh_cmd, ssh_target)
+            self.jumps = jumphosts.split(',')
+        elif conf.get('ProxyJump', 'none').lower() != 'none':
+            self.jumps = conf['ProxyJump'].split(',')
+        elif 'ProxyCommand' in conf and self._proxy_hop(conf['ProxyCommand']):
+            self.jumps = [ self._proxy_hop(conf['ProxyCommand']) ]
+        # master connection is checked without command-line options, ssh refuses -O with -W of transport invocations
+        self.master_cmd = ssh_cmd
+        if ssh_options:
+            ssh_cmd += " " + " ".join(ssh_options)
 
         self.ssh_target = ssh_target
-        self.ssh_command = "{} {}".format(ssh_cmd, ssh_target)
+        self.ssh_cmd = ssh_cmd
+        self.jumphosts = jumphosts
+        self.ssh_options = ssh_options
+        self.command = args
+        self.ssh_args = ""
         if args:
             debug(f"adding command args: '{args}'")
-            self.ssh_command += f" '{args}'"
+            self.ssh_args = f" '{args}'"
         self.post = post
         self.conf = conf
+        self.login = login or conf.get('login', "sshpass")
+        if self.login not in self.LOGINS:
+            raise self._err("invalid login engine '%s' for host '%s', must be one of %s" % (self.login, ssh_target, ', '.join(self.LOGINS)))
+        self.fifodir = None
+        self.fifofds = list()
+        self.fifolock = threading.Lock()
+        self.echo = True # show login and post actions output to the user
 
-    def run(self):
-        ssh_command = self.ssh_command
-        fpass = None
-        if 'pass' in self.conf:
-            if shutil.which('pass') is None:
-                raise self._err("you must install 'pass', see https://www.passwordstore.org/")
-            if shutil.which('sshpass') is None:
-                raise self._err("you must install 'sshpass'")
-
-            stricthostkeychecking = subprocess.run(f"ssh -G {self.ssh_target} |grep '^stricthostkeychecking ' |cut -d' ' -f2", shell=True, capture_output=True).stdout.decode().strip()
-            if stricthostkeychecking == 'yes':
-                debug("checking if target server public key is in ssh known_hosts")
-                hostname = subprocess.run(f"ssh -G {self.ssh_target} |grep '^hostname ' |cut -d' ' -f2", shell=True, capture_output=True).stdout.decode().strip()
-                check_res = subprocess.run(["ssh-keygen", "-l", "-F", hostname], capture_output=True)
-                if check_res.returncode == 1:
-                    # we cannot use ssh-keyscan when a proxy is involved, since ssh-keyscan does not respect ProxyJump / ProxyCommand
-                    self._err("fingerprints of SSH host '%s' not found !\nUse normal ssh(1) to accept the keys, or StrictHostKeyChecking in ssh_config(5)" % self.ssh_target)
+    def run(self, timeout=None, prefix=None, lock=None, output=None):
+        """run the connection and return its exit code, or None if it was killed after timeout seconds.
+        if prefix is set, the connection is non-interactive and each line of its output is prefixed.
+        if output is set, the connection is non-interactive and its output is written to this Jsonoutput"""
+        try:
+            return self._run(timeout, prefix, lock, output)
+        finally:
+            self.cleanup()
 
-            debug("setting-up sshpass using named pipe")
-            password = subprocess.run(["pass", self.conf['pass']], capture_output=True).stdout.strip()
+    def cleanup(self):
+        """close password pipes and remove password named pipes"""
+        for fd in self.fifofds:
+            os.close(fd)
+        self.fifofds = list()
+        if self.fifodir:
+            debug("removing password fifos in %s" % self.fifodir)
+            shutil.rmtree(self.fifodir, ignore_errors=True)
+            self.fifodir = None
+
+    def _run(self, timeout=None, prefix=None, lock=None, output=None):
+        if self.brokered:
+            result = self._run_brokered(self.command, timeout)
+            if output:
+                for stream in ["stdout", "stderr"]:
+                    for line in result[stream].encode().splitlines(keepends=True):
+                        output.write(self.destination, stream, line)
+            elif prefix is None:
+                sys.stdout.write(result['stdout'])
+                sys.stderr.write(result['stderr'])
+            else:
+                with lock or threading.Lock():
+                    for line in (result['stdout'] + result['stderr']).splitlines():
+                        print(prefix + line)
+            return result['exit']
+        # in-process login engine needs a terminal to hand over after log-in, and is always used with post actions
+        use_pexpect = len(self.post.keys()) > 0 or (self.login == 'pexpect' and prefix is None and output is None and os.isatty(sys.stdin.fileno()))
+        if len(self.post.keys()) > 0 and not os.isatty(sys.stdout.fileno()):
+            raise self._err("cannot use post actions in non-interactive shell")
+        ssh_command, password, pass_fds = self._command(use_pexpect)
+        if use_pexpect:
+            p = self._connect(ssh_command, password)
+            self._handoff(p)
+            p.close()
+            rc = p.exitstatus
+        else:
+            with PROFILE.phase("ssh", self.ssh_target):
+                rc = self._spawn(ssh_command, timeout, prefix, lock, pass_fds, output)
+        return rc
+
+    def session(self):
+        """log-in and run post actions, returning a Session running commands on the resulting shell.
+        the caller must close() the session"""
+        if self.ssh_args:
+            raise self._err("cannot open a session when command is provided")
+        self.echo = False
+        ssh_command, password, _ = self._command(True)
+        try:
+            return Session(self._connect(ssh_command, password), self.ssh_target)
+        finally:
+            self.cleanup()
+
+    def run_batch(self, commands, timeout=None, out=sys.stdout):
+        """run commands one after the other over a single log-in, writing one JSON result per command to out.
+        return 0 if all commands succeeded"""
+        rc = 0
+        brokered = len(self.post.keys()) > 0 and Sessionbroker.running()
+        session = None if brokered else self.session()
+        try:
+            for command in commands:
+                if brokered:
+                    result = self._run_brokered(command, timeout)
+                else:
+                    result = session.run(command, timeout or Session.COMMAND_TIMEOUT_DEFAULT)
+                result['host'] = self.destination
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                if result['exit'] != 0:
+                    rc = 1
+        finally:
+            if session:
+                session.close()
+        return rc
+
+    async def connect(self):
+        """log-in and run post actions without blocking the event loop, returning a Session on which commands are run
+        by Session.run_async(). the caller must close() the session"""
+        import asyncio
+        return await asyncio.to_thread(self.session)
+
+    async def run_command(self, command, timeout=None):
+        """run command without blocking the event loop, returning its result as a dict with exit code (None on timeout),
+        output, and durations of ocsh phases in 'timings'. destinations with post actions run command on a session,
+        kept by the session broker if one is running. an Octossh runs one command at a time"""
+        import asyncio
+        timings = dict()
+        PROFILE.timings.set(timings) # tasks and threads of asyncio.to_thread() get their own copy of the context
+        if self.post and await asyncio.to_thread(Sessionbroker.running):
+            result = await asyncio.to_thread(self._run_brokered, command, timeout)
+        elif self.post:
+            session = await self.connect()
+            try:
+                result = await session.run_async(command, timeout or Session.COMMAND_TIMEOUT_DEFAULT)
+            finally:
+                session.close()
+        else:
+            start = time.monotonic()
+            ssh_command, _, pass_fds = await asyncio.to_thread(self._command, False, command)
+            try:
+                with PROFILE.phase("ssh", self.ssh_target):
+                    # own process group, so that the whole sshpass / ssh pipeline can be killed on timeout
+                    p = await asyncio.create_subprocess_shell(ssh_command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                              start_new_session=True, pass_fds=pass_fds)
+                    # streams are read by their own tasks, so that output received before a timeout is kept
+                    readers = [ asyncio.ensure_future(p.stdout.read()), asyncio.ensure_future(p.stderr.read()) ]
+                    try:
+                        rc = await asyncio.wait_for(p.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        os.killpg(p.pid, signal.SIGKILL)
+                        await p.wait()
+                        rc = None
+                    stdout, stderr = await asyncio.gather(*readers)
+            finally:
+                self.cleanup()
+            result = {
+                'command': command,
+                'exit': rc,
+                'stdout': stdout.decode(errors='replace'),
+                'stderr': stderr.decode(errors='replace'),
+                'duration': round(time.monotonic() - start, 3),
+            }
+        result['host'] = self.destination
+        result['timings'] = {name: round(duration, 3) for name, duration in timings.items()}
+        return result
+
+    def _run_brokered(self, command, timeout=None):
+        """run command on the session broker, returning its result"""
+        debug("running on session broker: %s" % command)
+        conf_path = Path(self.sshconf.conf_path).absolute() if self.sshconf.conf_path else None
+        with PROFILE.phase("broker", self.ssh_target):
+            result = Sessionbroker.run(conf_path, self.destination, command, timeout, self.jumphosts, self.ssh_options, self.login)
+        if result is None:
+            self._err("session broker %s not reachable" % Sessionbroker.sockpath())
+        if 'error' in result:
+            self._err("session broker: %s" % result['error'])
+        return result
+
+    def _command(self, use_pexpect, command=None):
+        """return the command reaching the target and running command instead of the command line one if set,
+        its password when it has to be answered by the pexpect login engine, and file descriptors to pass to the command"""
+        ssh_cmd = self.ssh_cmd
+        master = 'master' in self.conf and self._master_alive()
+        if not master and self.race and not self.jumphosts:
+            route = self._race_routes()
+            self.jumps = route['jump'].split(',') if route['jump'] != 'none' else list()
+            if route['hostname'] != self.sshconf.resolve(self.ssh_target).get('hostname'):
+                ssh_cmd += " -o Hostname=%s" % route['hostname']
+            if 'proxy' not in route and not self.jumps and 'ProxyCommand' in self.conf:
+                ssh_cmd += " -o ProxyCommand=none"
+        if master:
+            debug("reusing master connection to %s" % self.ssh_target)
+        elif self.jumps:
+            debug("constructing jump hosts chain %s" % ','.join(self.jumps))
+            ssh_cmd += " -o ProxyCommand=%s" % shlex.quote(self._proxy_command(self.jumps))
+        if not master and 'ProxyJump' in self.conf:
+            ssh_cmd += " -o ProxyJump=none"
+        ssh_command = "{} {}{}".format(ssh_cmd, self.ssh_target, self.ssh_args if command is None else " " + shlex.quote(command))
+
+        password = None
+        if not master and 'pass' in self.conf:
+            if not self.host_key_known():
+                # we cannot use ssh-keyscan when a proxy is involved, since ssh-keyscan does not respect ProxyJump / ProxyCommand
+                self._err("fingerprints of SSH host '%s' not found !\nUse normal ssh(1) to accept the keys, or StrictHostKeyChecking in ssh_config(5)" % self.ssh_target)
+
+            password = self._pass(self.conf['pass'])
             if len(password) == 0:
                 self._err("pass: password not found for host %s : %s" % (self.ssh_target, self.conf['pass']))
-            fpass = Path(tempfile.mkdtemp()) / "fifo"
-            os.mkfifo(fpass)
-            fr = os.open(fpass, os.O_RDONLY | os.O_NONBLOCK)
-            fw = os.open(fpass, os.O_WRONLY)
-            os.write(fw, password)
-            os.write(fw, b'\n')
-            ssh_command = "sshpass -f{} {} ".format(fpass, ssh_command)
+
+        pass_fds = ()
+        if password and not use_pexpect and 'pre' in self.conf:
+            # pre commands such as sudo close inherited file descriptors, see closefrom in sudoers(5)
+            debug("setting-up sshpass using named pipe")
+            ssh_command = "sshpass -f{} {}".format(self._fifo(password), ssh_command)
+            password = None
+        elif password and not use_pexpect:
+            debug("setting-up sshpass using file descriptor")
+            fd = self._pipe(password)
+            pass_fds = (fd,)
+            ssh_command = "sshpass -d{} {}".format(fd, ssh_command)
+            password = None
 
         if 'pre' in self.conf:
             ssh_command = self.conf['pre'] + " " + ssh_command
 
         debug("running: %s" % ssh_command)
+        return ssh_command, password, pass_fds
+
+    def _connect(self, ssh_command, password):
+        """spawn ssh_command in a pty, log-in and run post actions"""
+        import pexpect
+        size = os.get_terminal_size(sys.stdout.fileno()) if self._echo_tty() else os.terminal_size((80, 24))
+        p = pexpect.spawn("/bin/sh", ["-c", ssh_command], dimensions=(size.lines, size.columns))
+        with PROFILE.phase("login", self.ssh_target):
+            state = self._login(p, password) if password else None
+        self._post_actions(p, state == self.LOGIN_EXPECT_3_SHELL)
+        return p
+
+    def _handoff(self, p):
+        """hand the terminal over to pexpect spawned p until it exits.
+        the pty of p stays owned by ocsh, so data is relayed with large reads and no per-byte processing,
+        and terminal window size changes are propagated to p"""
+        import tty, select, termios
+        stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+        if p.buffer:
+            os.write(stdout, p.buffer)
+            p.buffer = b""
+        def _winch(signum, frame):
+            size = os.get_terminal_size(stdout)
+            p.setwinsize(size.lines, size.columns)
+        prev_winch = signal.signal(signal.SIGWINCH, _winch)
+        mode = termios.tcgetattr(stdin)
+        tty.setraw(stdin)
+        try:
+            fds = [p.child_fd, stdin]
+            while p.child_fd in fds:
+                for fd in select.select(fds, [], [])[0]:
+                    try:
+                        data = os.read(fd, self.HANDOFF_READ_SIZE)
+                    except OSError:
+                        data = b"" # EIO on the pty once p has exited
+                    if not data:
+                        fds.remove(fd)
+                        continue
+                    dst = stdout if fd == p.child_fd else p.child_fd
+                    while data:
+                        data = data[os.write(dst, data):]
+        finally:
+            termios.tcsetattr(stdin, termios.TCSADRAIN, mode)
+            signal.signal(signal.SIGWINCH, prev_winch)
+
+    def _echo_tty(self):
+        """return True if output is shown to the user on a terminal. stdout may not be a file when ocsh is used as a library"""
+        try:
+            return self.echo and os.isatty(sys.stdout.fileno())
+        except (OSError, ValueError):
+            return False
 
-        if len(self.post.keys()) > 0:
-            p = pexpect.spawn(ssh_command)
-            for action in self.post.keys():
-                cmd, passname = self.post[action]
+    def _expect(self, p, patterns, timeout):
+        """expect patterns on pexpect spawned p, showing consumed output to the user"""
+        ret = p.expect(patterns, timeout=timeout)
+        if self._echo_tty():
+            sys.stdout.buffer.write(p.before + (p.after if isinstance(p.after, bytes) else b""))
+            sys.stdout.flush()
+        return ret
+
+    def _login(self, p, password):
+        """answer ssh password prompt of pexpect spawned p, returning the LOGIN_EXPECT state once logged-in"""
+        import pexpect
+        patterns = self.LOGIN_EXPECT + [pexpect.EOF, pexpect.TIMEOUT]
+        patterns[self.LOGIN_EXPECT_3_SHELL] = self.conf.get('prompt', self.PROMPT_DEFAULT)
+        sent = False
+        while True:
+            ret = self._expect(p, patterns, self.LOGIN_TIMEOUT)
+            if ret == self.LOGIN_EXPECT_0_ARE_YOU_SURE:
+                p.close()
+                self._err("fingerprints of SSH host '%s' not found !\nUse normal ssh(1) to accept the keys, or StrictHostKeyChecking in ssh_config(5)" % self.ssh_target)
+            elif ret == self.LOGIN_EXPECT_1_PASSWORD:
+                if sent:
+                    p.close()
+                    self._err("password refused by host %s" % self.ssh_target)
+                debug("login: sending password")
+                p.sendline(password)
+                sent = True
+            elif ret == self.LOGIN_EXPECT_2_PERMISSION_DENIED:
+                p.close()
+                self._err("permission denied by host %s" % self.ssh_target)
+            elif ret == self.LOGIN_EXPECT_3_SHELL:
+                debug("login: got shell" if sent else "login: got shell without password prompt, logged-in by key")
+                return ret
+            elif ret == self.LOGIN_EXPECT_4_EOF:
+                debug("login: connection closed")
+                return ret
+            elif ret == self.LOGIN_EXPECT_5_TIMEOUT:
+                if not sent:
+                    p.close()
+                    self._err("timeout waiting for password prompt from host %s" % self.ssh_target)
+                debug("login: no answer after password, assuming logged-in")
+                return ret
+
+    def _post_actions(self, p, at_prompt=False):
+        """run post actions on pexpect spawned p, each one as soon as the shell prompt of the previous one appears.
+        the duration of an action lasts until the shell prompt following it"""
+        import pexpect
+        prompt = self.conf.get('prompt', self.PROMPT_DEFAULT)
+        passprompt = self.conf.get('passprompt', self.PASSPROMPT_DEFAULT)
+        times = self._post_times()
+        durations = dict()
+        for action, (cmd, passname) in self.post.items():
+            budget = self._post_budget(times.get(action))
+            start = time.monotonic()
+            with PROFILE.phase("post %s" % action, self.ssh_target):
+                if not at_prompt:
+                    try:
+                        self._expect(p, prompt, budget)
+                    except (pexpect.TIMEOUT, pexpect.EOF) as e:
+                        self._err("timeout waiting for shell prompt before post action '%s' after %ss:\n%s" % (action, budget, e))
+                    at_prompt = True
                 debug("post action : %s" % cmd)
                 p.sendline(cmd)
                 if passname:
-                    try:
-                        p.expect("\n", timeout=10)
-                    except Exception as e:
-                        self._err("timeout waiting for shell in post action %s:\n%s" % (action, e))
-                    if shutil.which('pass') is None:
-                        raise self._err("you must install 'pass', see https://www.passwordstore.org/")
-                    password = subprocess.run(["pass", passname], capture_output=True).stdout.decode().strip()
+                    password = self._pass(passname)
                     if len(password) == 0:
                         self._err("pass: password not found for host %s, post action %s : %s" % (self.ssh_target, cmd, passname))
                     try:
-                        p.expect("[Pp]assword[^:]*:", timeout=5)
-                    except Exception as e:
-                        self._err("timeout waiting for password in post action '%s':\n%s" % (action, e))
+                        self._expect(p, passprompt, budget)
+                    except (pexpect.TIMEOUT, pexpect.EOF) as e:
+                        self._err("timeout waiting for password in post action '%s' after %ss:\n%s" % (action, budget, e))
                     p.sendline(password)
-            p.interact()
-        else:
-            subprocess.run(ssh_command, shell=True)
+                try:
+                    self._expect(p, prompt, budget)
+                except (pexpect.TIMEOUT, pexpect.EOF) as e:
+                    self._err("timeout waiting for shell prompt after post action '%s' after %ss:\n%s" % (action, budget, e))
+            durations[action] = time.monotonic() - start
+        if durations:
+            info("post actions done: %s" % ', '.join("%s %.2fs" % (a, d) for a, d in durations.items()))
+            self._post_times_save(durations)
+
+    def _post_budget(self, recent):
+        """timeout for a post action step: from annotation, or learned from recent durations on this host"""
+        if 'posttimeout' in self.conf:
+            return float(self.conf['posttimeout'])
+        if recent:
+            return max(self.POST_TIMEOUT_DEFAULT, self.POST_TIMEOUT_FACTOR * max(recent))
+        return self.POST_TIMEOUT_DEFAULT
+
+    def _post_times(self):
+        try:
+            return json.loads(self.POST_TIMES_PATH.read_text()).get(self.ssh_target, dict())
+        except (OSError, ValueError):
+            return dict()
+
+    def _post_times_save(self, durations):
+        try:
+            alltimes = json.loads(self.POST_TIMES_PATH.read_text())
+        except (OSError, ValueError):
+            alltimes = dict()
+        times = alltimes.setdefault(self.ssh_target, dict())
+        for action, duration in durations.items():
+            times[action] = (times.get(action, list()) + [round(duration, 3)])[-self.POST_TIMES_KEEP:]
+        try:
+            write_atomic(self.POST_TIMES_PATH, json.dumps(alltimes).encode())
+        except OSError as e:
+            debug("could not save post actions durations to %s: %s" % (self.POST_TIMES_PATH, e))
+
+    def _proxy_command(self, jumps, depth=0):
+        """return ProxyCommand reaching %h:%p through the jumps hosts chain, the last hop being the nearest to the target.
+        each hop is a plain ssh -W, authenticated by sshpass if it has a pass annotation"""
+        if depth > 16:
+            raise self._err("too many jump hosts reaching %s, ProxyJump loop ?" % jumps[-1])
+        m = re.match(r"((?P<user>[^@]+)@)?(?P<host>[^:@]+)(:(?P<port>\d+))?$", jumps[-1])
+        if not m:
+            raise self._err("invalid jump host '%s'" % jumps[-1])
+        conf = self.sshconf.lookup(m['host'])
+        cmd = conf.get('cmd', "ssh")
+        if logging.root.level == logging.DEBUG:
+            cmd += " -v"
+        if self.sshconf.conf_path:
+            cmd += " -F %s" % self.sshconf.conf_path
+        if m['user']:
+            cmd += " -l %s" % m['user']
+        if m['port']:
+            cmd += " -p %s" % m['port']
+        inner = jumps[:-1]
+        if not inner and conf.get('ProxyJump', 'none').lower() != 'none':
+            inner = conf['ProxyJump'].split(',')
+        elif not inner and 'ProxyJump' not in conf and 'ProxyCommand' in conf and self._proxy_hop(conf['ProxyCommand']):
+            inner = [ self._proxy_hop(conf['ProxyCommand']) ]
+        if inner:
+            # nested ProxyCommand tokens are expanded by each ssh in the chain, escape them once per level
+            cmd += " -o ProxyCommand=%s" % shlex.quote(self._proxy_command(inner, depth+1).replace('%', '%%'))
+        if 'ProxyJump' in conf:
+            cmd += " -o ProxyJump=none"
+        cmd += " -W %h:%p " + m['host']
+        if 'pass' in conf:
+            password = self._pass(conf['pass'])
+            if len(password) == 0:
+                self._err("pass: password not found for jump host %s : %s" % (m['host'], conf['pass']))
+            cmd = "sshpass -f{} {}".format(self._fifo(password), cmd)
+        if 'pre' in conf:
+            cmd = conf['pre'] + " " + cmd
+        return cmd
+
+    def _proxy_hop(self, proxycommand):
+        """return jump host [user@]host[:port] of a ProxyCommand using ssh to forward to %h:%p, as 'ssh -W %h:%p host' or
+        'ssh host nc %h %p', so that it is resolved by _proxy_command like ProxyJump. None for other ProxyCommand"""
+        try:
+            args = shlex.split(proxycommand)
+        except ValueError:
+            return None
+        if not args or not args[0].endswith('ssh'):
+            return None
+        opts, dest = dict(), None
+        i = 1
+        while i < len(args):
+            arg = args[i]
+            i += 1
+            if not arg.startswith('-') or len(arg) == 1:
+                dest = arg
+                break
+            for n, flag in enumerate(arg[1:], 1):
+                if flag in "BbcDEeFIiJLlmOoPpQRSWw":
+                    if n + 1 < len(arg):
+                        opts[flag] = arg[n+1:]
+                    elif i < len(args):
+                        opts[flag] = args[i]
+                        i += 1
+                    break
+                opts[flag] = True
+        remote = args[i:]
+        # other options, as identity or config ones, would be lost if the hop was rebuilt
+        if dest is None or '%' in dest or not set(opts) <= set("lpWqvTN46"):
+            return None
+        if not ((opts.get('W') == "%h:%p" and not remote) or ('W' not in opts and remote in (["nc", "%h", "%p"], ["netcat", "%h", "%p"]))):
+            return None
+        m = re.match(r"((?P<user>[^@]+)@)?(?P<host>[^:@]+)(:(?P<port>\d+))?$", dest.replace("ssh://", "", 1))
+        if not m:
+            return None
+        user, port = opts.get('l', m['user']), opts.get('p', m['port'])
+        return "{}{}{}".format(user + "@" if user else "", m['host'], ":" + port if port else "")
+
+    def _pipe(self, password):
+        """return read end of a pipe holding password, to be inherited by sshpass -d, closed at the end of run()"""
+        if which('sshpass') is None:
+            raise self._err("you must install 'sshpass'")
+        fr, fw = os.pipe()
+        os.write(fw, password.encode() + b'\n')
+        os.close(fw)
+        self.fifofds.append(fr)
+        return fr
+
+    def _fifo(self, password):
+        """return path of a named pipe holding password for sshpass, removed at the end of run()"""
+        if which('sshpass') is None:
+            raise self._err("you must install 'sshpass'")
+        with self.fifolock:
+            if not self.fifodir:
+                self.fifodir = Path(tempfile.mkdtemp(prefix="ocsh-"))
+            fpass = self.fifodir / ("fifo%d" % len(list(self.fifodir.iterdir())))
+            os.mkfifo(fpass, 0o600)
+            # keep both ends open, so that the password stays buffered in the pipe until sshpass reads it
+            fr = os.open(fpass, os.O_RDONLY | os.O_NONBLOCK)
+            fw = os.open(fpass, os.O_WRONLY)
+            os.write(fw, password.encode() + b'\n')
+            self.fifofds += [fr, fw]
+        return fpass
+
+    def host_key_known(self):
+        """return False if StrictHostKeyChecking is enabled and the target host key is not in known_hosts files"""
+        settings = self.sshconf.resolve(self.ssh_target)
+        # ssh -G prints 'true' for yes. accept-new, no and off let ssh accept unknown keys, ask is answered by the login engine
+        if settings.get('stricthostkeychecking') not in ('yes', 'true'):
+            return True
+        debug("checking if target server public key is in ssh known_hosts")
+        name = settings.get('hostkeyalias', 'none')
+        if name == 'none':
+            name = settings.get('hostname', self.ssh_target)
+            if settings.get('port', '22') != '22':
+                name = "[%s]:%s" % (name, settings['port'])
+        paths = settings.get('userknownhostsfile', '').split() + settings.get('globalknownhostsfile', '').split()
+        return Knownhosts.load(paths).contains(name)
+
+    def _race_routes(self):
+        """return the first route {'jump', 'hostname'[, 'proxy']}, among the configured one and 'alt' annotations, to get the
+        SSH banner of the target. routes are tried every ROUTE_DELAY seconds or as soon as the previous one failed, and routes
+        that failed are skipped by later invocations for UNREACHABLE_TTL seconds"""
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        settings = self.sshconf.resolve(self.ssh_target)
+        primary = {'jump': ','.join(self.jumps) or 'none', 'hostname': settings.get('hostname', self.ssh_target)}
+        if not self.jumps and 'ProxyCommand' in self.conf and self.conf['ProxyCommand'].lower() != 'none':
+            primary['proxy'] = self.conf['ProxyCommand']
+        routes = [primary]
+        for alt in self.conf.get('alt', list()):
+            route = dict(primary, **alt)
+            if 'jump' in alt:
+                route.pop('proxy', None)
+            routes.append(route)
+        unreachable = self._unreachable()
+        candidates = [r for r in routes if self._route_key(r) not in unreachable]
+        if not candidates:
+            self._err("all routes to %s failed less than %ds ago, see %s" % (self.ssh_target, self.UNREACHABLE_TTL, self.UNREACHABLE_PATH))
+        stop = threading.Event()
+        pending, failed, winner = dict(), list(), None
+        with PROFILE.phase("route", self.ssh_target):
+            pool = ThreadPoolExecutor(max_workers=len(candidates))
+            while (candidates or pending) and not winner:
+                if candidates:
+                    route = candidates.pop(0)
+                    debug("route to %s: trying %s" % (self.ssh_target, self._route_key(route)))
+                    pending[pool.submit(self._probe_route, route, settings.get('port', "22"), stop)] = route
+                done, _ = wait(pending, timeout=self.ROUTE_DELAY if candidates else None, return_when=FIRST_COMPLETED)
+                for f in done:
+                    route = pending.pop(f)
+                    if f.result():
+                        winner = winner or route
+                    else:
+                        failed.append(route)
+            stop.set()
+            pool.shutdown(wait=False)
+        self._unreachable_save(failed)
+        if not winner:
+            self._err("no route to %s answered: %s" % (self.ssh_target, ', '.join(self._route_key(r) for r in failed)))
+        if winner is not primary:
+            info("route to %s: using %s" % (self.ssh_target, self._route_key(winner)))
+        return winner
+
+    def _probe_route(self, route, port, stop):
+        """return True if the SSH banner of the target is received through route before ROUTE_TIMEOUT or stop is set"""
+        import socket, select
+        deadline = time.monotonic() + self.ROUTE_TIMEOUT
+        try:
+            if route['jump'] == 'none' and 'proxy' not in route:
+                with socket.create_connection((route['hostname'], int(port)), timeout=self.ROUTE_TIMEOUT) as s:
+                    return s.recv(4).startswith(b"SSH-")
+            # run the configured ProxyCommand or the jump hosts chain like ssh would, expanding its tokens
+            cmd = route['proxy'] if 'proxy' in route else self._proxy_command(route['jump'].split(','))
+            tokens = {'h': route['hostname'], 'p': port, 'n': self.ssh_target, 'r': self.sshconf.resolve(self.ssh_target).get('user', ""), '%': "%"}
+            cmd = re.sub(r"%(.)", lambda m: tokens.get(m[1], m[0]), cmd)
+            p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, start_new_session=True)
+            try:
+                while not stop.is_set() and time.monotonic() < deadline:
+                    if select.select([p.stdout], [], [], 0.1)[0]:
+                        return os.read(p.stdout.fileno(), 4).startswith(b"SSH-")
+                return False
+            finally:
+                with contextlib.suppress(OSError):
+                    os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+        except (OSError, OcshError) as e:
+            debug("route to %s: %s failed: %s" % (self.ssh_target, self._route_key(route), e))
+            return False
 
-        if fpass:
-            debug("removing password fifo %s" % fpass)
-            fpass.unlink()
-            fpass.parent.rmdir()
+    def _route_key(self, route):
+        if 'proxy' in route:
+            return "%s hostname=%s proxy=%s" % (self.ssh_target, route['hostname'], route['proxy'])
+        return "%s hostname=%s jump=%s" % (self.ssh_target, route['hostname'], route['jump'])
+
+    def _unreachable(self):
+        """return keys of routes that failed less than UNREACHABLE_TTL seconds ago"""
+        if self.UNREACHABLE_TTL <= 0:
+            return set()
+        try:
+            return {k for k, expiry in json.loads(self.UNREACHABLE_PATH.read_text()).items() if expiry > time.time()}
+        except (OSError, ValueError):
+            return set()
+
+    def _unreachable_save(self, routes):
+        if not routes or self.UNREACHABLE_TTL <= 0:
+            return
+        try:
+            entries = {k: e for k, e in json.loads(self.UNREACHABLE_PATH.read_text()).items() if e > time.time()}
+        except (OSError, ValueError):
+            entries = dict()
+        entries.update({self._route_key(r): time.time() + self.UNREACHABLE_TTL for r in routes})
+        try:
+            write_atomic(self.UNREACHABLE_PATH, json.dumps(entries).encode())
+        except OSError as e:
+            debug("could not save unreachable routes to %s: %s" % (self.UNREACHABLE_PATH, e))
+
+    def _master_alive(self):
+        return subprocess.run("%s -O check %s" % (self.master_cmd, self.ssh_target), shell=True, capture_output=True).returncode == 0
+
+    def _pass(self, passname):
+        """return secret from pass(1), trying first this process memory and the ocsh agent"""
+        with Octossh.secrets_lock:
+            if passname in Octossh.secrets and Octossh.secrets[passname][1] > time.monotonic():
+                return Octossh.secrets[passname][0]
+            with PROFILE.phase("agent", self.ssh_target):
+                secret = Passagent.get(passname)
+            if secret is None:
+                if which('pass') is None:
+                    raise self._err("you must install 'pass', see https://www.passwordstore.org/")
+                with PROFILE.phase("pass", self.ssh_target):
+                    secret = subprocess.run(["pass", passname], capture_output=True).stdout.decode().strip()
+                if secret:
+                    Passagent.put(passname, secret)
+            else:
+                debug("pass: secret %s read from agent" % passname)
+            Octossh.secrets[passname] = (secret, time.monotonic() + self.SECRETS_TTL)
+            return secret
+
+    @classmethod
+    def flush_secrets(cls):
+        """forget secrets kept by this process, returning their count"""
+        with cls.secrets_lock:
+            count = len(cls.secrets)
+            cls.secrets.clear()
+        return count
+
+    def _spawn(self, ssh_command, timeout=None, prefix=None, lock=None, pass_fds=(), output=None):
+        if prefix is None and output is None:
+            try:
+                return subprocess.run(ssh_command, shell=True, timeout=timeout, pass_fds=pass_fds).returncode
+            except subprocess.TimeoutExpired:
+                warning("timeout after %ss on %s" % (timeout, self.ssh_target))
+                return None
+
+        lock = lock or threading.Lock()
+        # own process group, so that the whole sshpass / ssh pipeline can be killed on timeout
+        p = subprocess.Popen(ssh_command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE if output else subprocess.STDOUT,
+                             start_new_session=True, pass_fds=pass_fds)
+        expired = threading.Event()
+        def _kill():
+            expired.set()
+            os.killpg(p.pid, signal.SIGKILL)
+        timer = threading.Timer(timeout, _kill) if timeout else None
+        if timer:
+            timer.start()
+        if output:
+            def _stream(pipe, stream):
+                for chunk in iter(lambda: pipe.readline(output.CHUNK_SIZE), b""):
+                    output.write(self.destination, stream, chunk)
+            reader = threading.Thread(target=_stream, args=(p.stderr, "stderr"))
+            reader.start()
+            _stream(p.stdout, "stdout")
+            reader.join()
+        else:
+            for line in p.stdout:
+                with lock:
+                    sys.stdout.write(prefix + line.decode(errors='replace'))
+                    sys.stdout.flush()
+        rc = p.wait()
+        if timer:
+            timer.cancel()
+        if expired.is_set():
+            with lock:
+                warning("timeout after %ss on %s" % (timeout, self.ssh_target))
+            return None
+        return rc
 
     def _get_target_cmd(self, target):
         # read user provided target and options
-        usr = re.match(r"((?P<user>\w+)@)?(?P<host>\w+)(\[(?P<post>.*)\])?", target).groupdict()
+        usr = re.match(r"((?P<user>[\w.-]+)@)?(?P<host>[\w.-]+)(\[(?P<post>.*)\])?", target).groupdict()
         target = target.rsplit('[', 1)[0] # remove post-login actions from target command-line
 
-        # if host in configuration, read parameters not yet existing
-        conf = dict()
+        # read parameters of Host and Match blocks applying to host
+        conf = self.conf.lookup(usr['host'])
         post = dict()
-        if usr['host'] in self.conf.hosts:
-            conf = self.conf.hosts[usr['host']]
-            if usr['post']:
-                for action in usr['post'].split(','):
-                    if action in conf['post']:
-                        post[action] = conf['post'][action]
-                    else:
-                        raise self._err("invalid action '%s' for host '%s'" % (action, usr['host']))
-                
+        if usr['post']:
+            for action in usr['post'].split(','):
+                if action in conf['post']:
+                    post[action] = conf['post'][action]
+                else:
+                    raise self._err("invalid action '%s' for host '%s'" % (action, usr['host']))
+
         # construct command to reach target
         if 'cmd' in conf:
             ssh_cmd = conf['cmd']
@@ -324,11 +2101,13 @@ class Octossh(object):
             ssh_cmd += " -v"
         if self.conf.conf_path:
             ssh_cmd += " -F %s" % self.conf.conf_path
-        if 'ProxyJump' in conf:
-            # if ProxyJump in ssh_config(5), replace with ocsh
-            ssh_cmd += ' -o ProxyCommand="{} -W %h:%p {}" -o ProxyJump=None'.format(self.prog, conf['ProxyJump'])
-        elif 'ProxyCommand' in conf:
-            # if ProxyCommand in ssh_config(5) uses ssh, replace with ocsh
+        if 'master' in conf:
+            # %C hash keeps the socket path under the sun_path limit, destination names are recorded for --ocsh-masters
+            self.MASTERS_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self._masters_record(target)
+            ssh_cmd += " -o ControlMaster=auto -o ControlPath={}/%C -o ControlPersist={}".format(self.MASTERS_DIR, conf['master'])
+        if 'ProxyCommand' in conf and 'ProxyJump' not in conf and not self._proxy_hop(conf['ProxyCommand']):
+            # if ProxyCommand in ssh_config(5) uses ssh in a way _proxy_command cannot rebuild, replace with ocsh
             pcmd = conf['ProxyCommand'].split(' ')
             if pcmd[0].endswith('ssh'):
                 ssh_cmd += ' -o ProxyCommand="{} {}"'.format(self.prog, ' '.join(pcmd[1:]))
@@ -336,10 +2115,18 @@ class Octossh(object):
         return ssh_cmd, target, post, conf
 
     def _err(self, msg):
-        error("error: %s" % msg)
-        sys.exit(1)
+        raise OcshError(msg)
 
 def main():
+    try:
+        return _main()
+    except OcshError as e:
+        if not logging.getLogger().handlers:
+            logging.basicConfig(format='ocsh: %(message)s')
+        error("error: %s" % e)
+        return 1
+
+def _main():
     parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=SUMMARY, formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-F', '--ssh-config', default=Sshconf.CONFPATH_DEFAULT, help=argparse.SUPPRESS)
     parser.add_argument('-W', '--ssh-port-fw', help=argparse.SUPPRESS)
@@ -347,7 +2134,30 @@ def main():
     parser.add_argument('--ocsh-verbose', action='store_const', dest="loglevel", const=logging.DEBUG, default=logging.INFO, help="enable debug messages")
     parser.add_argument('--ocsh-pretend', action='store_true', help="do not actually perform the connection")
     parser.add_argument('--ocsh-examples', action='store_true', help="show example ocsh configuration and commands")
+    parser.add_argument('--ocsh-login', choices=Octossh.LOGINS, help="password login engine, overrides '# ocsh login' annotation (default: sshpass)")
+    parser.add_argument('--ocsh-parallel', type=int, default=1, metavar='N', help="connect to N hosts in parallel for multiple hosts destination")
+    parser.add_argument('--ocsh-timeout', type=float, metavar='SEC', help="abort connection to a host after SEC seconds")
+    parser.add_argument('--ocsh-unreachable-ttl', type=int, default=Octossh.UNREACHABLE_TTL, metavar='SEC', help="skip routes of '# ocsh alt' hosts, and hosts probed by --ocsh-probe, that failed less than SEC seconds ago, 0 to always try all routes (default: %(default)s)")
+    parser.add_argument('--ocsh-probe', action='store_true', help="probe hosts without '# ocsh alt' routes before connecting, so that dead hosts fail fast and are skipped by the next runs")
+    parser.add_argument('--ocsh-output', choices=["text", "jsonl"], default="text", help="output of multiple hosts as prefixed text lines, or JSON lines records with a final record per host (default: %(default)s)")
+    parser.add_argument('--ocsh-output-max', type=int, default=Jsonoutput.MAX_BYTES_DEFAULT, metavar='BYTES', help="jsonl output: write at most BYTES of output per host, dropping the rest (default: %(default)s)")
+    parser.add_argument('--ocsh-output-spill', metavar='DIR', help="jsonl output: write output beyond --ocsh-output-max to files in DIR instead of dropping it")
+    parser.add_argument('--ocsh-batch', metavar='FILE', help="run commands of FILE, one per line or '-' for stdin, over a single log-in and post actions, printing JSON results")
+    parser.add_argument('--ocsh-rebuild-cache', action='store_true', help="force rebuild of the parsed ssh_config(5) cache")
+    parser.add_argument('--ocsh-agent', action='store_true', help="run agent keeping secrets from pass in memory")
+    parser.add_argument('--ocsh-agent-ttl', type=int, default=Passagent.TTL_DEFAULT, metavar='SEC', help="agent and broker: forget secrets after SEC seconds (default: %(default)s)")
+    parser.add_argument('--ocsh-agent-max', type=int, default=Passagent.MAX_ENTRIES_DEFAULT, metavar='N', help="agent: keep at most N secrets, evicting least recently used (default: %(default)s)")
+    parser.add_argument('--ocsh-agent-flush', action='store_true', help="make the running agent, and session broker, forget all secrets")
+    parser.add_argument('--ocsh-broker', action='store_true', help="run session broker keeping shells after post actions, for commands and batches on host[action]")
+    parser.add_argument('--ocsh-broker-idle', type=int, default=Sessionbroker.IDLE_DEFAULT, metavar='SEC', help="broker: close sessions idle for SEC seconds (default: %(default)s)")
+    parser.add_argument('--ocsh-broker-max', type=int, default=Sessionbroker.MAX_PER_HOST_DEFAULT, metavar='N', help="broker: open at most N sessions per host[action] (default: %(default)s)")
+    parser.add_argument('--ocsh-sessions', action='store_true', help="list sessions kept by the broker")
+    parser.add_argument('--ocsh-sessions-close', nargs='?', const="", metavar='NAME', help="close sessions kept by the broker, all or matching NAME")
+    parser.add_argument('--ocsh-masters', action='store_true', help="list master connections")
+    parser.add_argument('--ocsh-masters-close', nargs='?', const="", metavar='NAME', help="close master connections, all or matching NAME")
+    parser.add_argument('--ocsh-profile', metavar='FILE', help="write duration of ocsh phases to FILE in Chrome trace format, and show a summary")
     parser.add_argument('--ocsh-install-autocompletion', action='store_true', help="install bash autocompletion for the current user")
+    parser.add_argument('--ocsh-complete', metavar='WORD', help=argparse.SUPPRESS)
     parser.add_argument('destination', nargs='?', help='host[action] or regex for multiple hosts')
     parser.add_argument('args', nargs=argparse.REMAINDER, help='any OpenSSH options or remote command')
     args, ssh_options = parser.parse_known_args()
@@ -359,33 +2169,109 @@ def main():
     # XXX TODO create a custom parser that would pass ssh-* arguments more smoothly. Need our parser to know all SSH arguments.
     ssh_args = ' '.join(args.args)
     if args.ssh_port_fw:
-        ssh_args += "-W {}".format(args.ssh_port_fw)
+        ssh_options = ["-W", args.ssh_port_fw] + ssh_options
 
     if args.ocsh_install_autocompletion:
         Octossh.install_bash_completion()
         sys.exit(0)
 
-    if not args.destination:
+    if args.ocsh_complete is not None:
+        print("\n".join(Sshconf(Path(args.ssh_config), index_only=True).complete(args.ocsh_complete)))
+        sys.exit(0)
+
+    if args.ocsh_agent or args.ocsh_agent_flush:
+        logging.basicConfig(level=args.loglevel, format='ocsh: %(message)s')
+        if args.ocsh_agent_flush:
+            # the session broker keeps secrets of its sessions too
+            res, broker = Passagent.flush(), Sessionbroker.request({'op': 'flush'})
+            if res is None and broker is None:
+                error("error: no agent running on %s" % Passagent.sockpath())
+                sys.exit(1)
+            if res is not None:
+                print("agent forgot %d secrets" % res['flushed'])
+            if broker is not None:
+                print("broker forgot %d secrets" % broker['flushed'])
+            sys.exit(0)
+        Passagent(ttl=args.ocsh_agent_ttl, max_entries=args.ocsh_agent_max).serve()
+        sys.exit(0)
+
+    if args.ocsh_broker or args.ocsh_sessions or args.ocsh_sessions_close is not None:
+        logging.basicConfig(level=args.loglevel, format='ocsh: %(message)s')
+        if args.ocsh_sessions:
+            Octossh.list_sessions()
+        elif args.ocsh_sessions_close is not None:
+            Octossh.close_sessions(args.ocsh_sessions_close)
+        else:
+            if args.ocsh_broker_idle < 1:
+                parser.error("--ocsh-broker-idle must be at least 1 second")
+            Octossh.SECRETS_TTL = args.ocsh_agent_ttl
+            Sessionbroker(idle=args.ocsh_broker_idle, max_per_host=args.ocsh_broker_max).serve()
+        sys.exit(0)
+
+    if args.ocsh_masters:
+        Octossh.list_masters()
+        sys.exit(0)
+    if args.ocsh_masters_close is not None:
+        Octossh.close_masters(args.ocsh_masters_close)
+        sys.exit(0)
+
+    if not args.destination and not args.ocsh_rebuild_cache:
         parser.print_usage()
         sys.exit(0)
 
     logging.basicConfig(level=args.loglevel, format='ocsh: %(message)s')
+    Octossh.UNREACHABLE_TTL = args.ocsh_unreachable_ttl
+    if args.ocsh_profile:
+        PROFILE.enable(args.ocsh_profile)
+    elif Profile.ENV in os.environ:
+        PROFILE.enable(os.environ[Profile.ENV], root=False)
 
-    c = Sshconf(Path(args.ssh_config))
+    c = Sshconf(Path(args.ssh_config), rebuild=args.ocsh_rebuild_cache)
+    if not args.destination:
+        print("ssh_config cache rebuilt in %s" % c.cache_path)
+        sys.exit(0)
 
     destinations = list()
     if '*' in args.destination:
-        for h in c.hosts:
-            if re.match(args.destination, h):
-                destinations.append(h)
+        destinations = c.expand(args.destination)
     else:
         destinations.append(args.destination)
-    for dest in destinations:
-        if len(destinations) > 1:
-            print("[+] target : %s" % dest)
-        o = Octossh(c, dest, args.ssh_jump_host, ssh_args, ssh_options)
+    octosshs = [Octossh(c, dest, args.ssh_jump_host, ssh_args, ssh_options, args.ocsh_login) for dest in destinations]
+    if args.ocsh_probe:
+        # dead hosts fail after ROUTE_TIMEOUT, and are skipped by the next runs for UNREACHABLE_TTL, instead of holding
+        # a worker until ssh gives up. hosts behind jump hosts are not probed, it would log-in twice on the hops
+        for o in octosshs:
+            o.race = o.race or (o.probeable and not o.jumps and 'ProxyCommand' not in o.conf)
+    if not args.ocsh_pretend:
+        Octossh.check_host_keys(octosshs)
+    if args.ocsh_batch:
+        f = sys.stdin if args.ocsh_batch == '-' else open(args.ocsh_batch)
+        with f:
+            commands = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+        if args.ocsh_pretend:
+            return 0
+        return max(o.run_batch(commands, args.ocsh_timeout) for o in octosshs)
+    if args.ocsh_output == "jsonl":
+        output = Jsonoutput(max_bytes=args.ocsh_output_max, spill_dir=args.ocsh_output_spill)
+        return Octossh.run_parallel(octosshs, max(args.ocsh_parallel, 1), args.ocsh_timeout, args.ocsh_pretend, output)
+    if args.ocsh_parallel > 1 and len(octosshs) > 1:
+        return Octossh.run_parallel(octosshs, args.ocsh_parallel, args.ocsh_timeout, args.ocsh_pretend)
+    results = list()
+    for o in octosshs:
+        if len(octosshs) > 1:
+            print("[+] target : %s" % o.destination)
         if not args.ocsh_pretend:
-            o.run()
+            try:
+                results.append(o.run(timeout=args.ocsh_timeout))
+            except OcshError as e:
+                if len(octosshs) == 1:
+                    raise
+                error("error: %s" % e)
+                results.append(1)
+    # exit code of the connection for a single host, as expected by rsync / scp transport, otherwise 1 if any host failed
+    if len(results) == 1:
+        return 1 if results[0] is None else results[0]
+    return 1 if any(rc != 0 for rc in results) else 0
 
 if __name__ == "__main__":
     sys.exit(main())
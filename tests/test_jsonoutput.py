@@ -0,0 +1,55 @@
+# JSON lines output of Jsonoutput, with output limits, run with: python3 -m pytest tests
+
+import io
+import sys
+import json
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import ocsh
+
+def records(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+def test_records():
+    out = io.StringIO()
+    j = ocsh.Jsonoutput(out)
+    j.write("web-01", "stdout", b"up\n")
+    j.write("web-01", "stderr", b"\xff\n")
+    j.close("web-01", 0, 1.23456, {'ssh': 0.5})
+    r = records(out)
+    assert [(x['host'], x['stream'], x.get('data')) for x in r] == [("web-01", "stdout", "up\n"), ("web-01", "stderr", "�\n"), ("web-01", "exit", None)]
+    assert r[2]['exit'] == 0
+    assert r[2]['duration'] == 1.235
+    assert r[2]['timings'] == {'ssh': 0.5}
+    assert (r[2]['bytes'], r[2]['dropped'], r[2]['spilled']) == (5, 0, {})
+
+def test_overflow():
+    out = io.StringIO()
+    j = ocsh.Jsonoutput(out, max_bytes=10)
+    j.write("web-01", "stdout", b"12345678")
+    j.write("web-01", "stdout", b"abcdef")
+    # smaller chunks after the limit are dropped too, keeping output in order
+    j.write("web-01", "stdout", b"x")
+    j.write("web-02", "stdout", b"other")
+    j.close("web-01", 0, 0)
+    j.close("web-02", 0, 0)
+    r = records(out)
+    assert [x.get('data') for x in r if x['host'] == "web-01"] == ["12345678", None]
+    assert (r[-2]['bytes'], r[-2]['dropped']) == (8, 7)
+    assert (r[-1]['bytes'], r[-1]['dropped']) == (5, 0)
+
+def test_spill(tmp_path):
+    out = io.StringIO()
+    j = ocsh.Jsonoutput(out, max_bytes=4, spill_dir=tmp_path / "spill")
+    j.write("u@web:22", "stdout", b"1234")
+    j.write("u@web:22", "stdout", b"5678")
+    j.write("u@web:22", "stderr", b"err")
+    j.write("u@web:22", "stdout", b"9")
+    j.close("u@web:22", 1, 0)
+    exit = records(out)[-1]
+    spill = tmp_path / "spill"
+    assert exit['spilled'] == {'stdout': str(spill / "u@web_22.stdout"), 'stderr': str(spill / "u@web_22.stderr")}
+    assert (spill / "u@web_22.stdout").read_bytes() == b"56789"
+    assert (spill / "u@web_22.stderr").read_bytes() == b"err"
+    assert (exit['bytes'], exit['dropped']) == (4, 0)
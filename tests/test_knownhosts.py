@@ -0,0 +1,76 @@
+# known_hosts(5) entries matched by Knownhosts.contains(), run with: python3 -m pytest tests
+
+import sys
+import hmac
+import base64
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import ocsh
+
+SALT = b"0123456789abcdefghij"
+
+def hashed(name):
+    return "|1|%s|%s" % (base64.b64encode(SALT).decode(), base64.b64encode(hmac.digest(SALT, name.encode(), 'sha1')).decode())
+
+KNOWN_HOSTS = """# comment
+web-01,10.0.0.1 ssh-ed25519 AAAA
+[db]:2222 ssh-ed25519 AAAA
+{hashed} ssh-ed25519 AAAA
+|1|invalid ssh-ed25519 AAAA
+*.lan,!bad.lan ssh-ed25519 AAAA
+node? ssh-ed25519 AAAA
+@revoked revoked ssh-ed25519 AAAA
+@cert-authority *.corp ssh-ed25519 AAAA
+UPPER ssh-ed25519 AAAA
+""".format(hashed=hashed("secret"))
+
+def knownhosts(tmp_path, cache_dir=None):
+    path = tmp_path / "known_hosts"
+    if not path.exists():
+        path.write_text(KNOWN_HOSTS)
+    return ocsh.Knownhosts([path], cache_dir=cache_dir)
+
+def test_names(tmp_path):
+    k = knownhosts(tmp_path)
+    assert k.contains("web-01")
+    assert k.contains("10.0.0.1")
+    assert k.contains("upper")
+    assert not k.contains("web-02")
+
+def test_port(tmp_path):
+    k = knownhosts(tmp_path)
+    assert k.contains("[db]:2222")
+    assert not k.contains("db")
+    assert not k.contains("[db]:22")
+
+def test_hashed(tmp_path):
+    k = knownhosts(tmp_path)
+    assert k.contains("secret")
+    assert not k.contains("other")
+
+def test_patterns(tmp_path):
+    k = knownhosts(tmp_path)
+    assert k.contains("host.lan")
+    assert not k.contains("bad.lan")
+    assert k.contains("node1")
+    assert not k.contains("node12")
+
+def test_markers(tmp_path):
+    k = knownhosts(tmp_path)
+    assert not k.contains("revoked")
+    assert k.contains("host.corp")
+
+def test_missing_file(tmp_path):
+    k = ocsh.Knownhosts([tmp_path / "missing", "%d/.ssh/known_hosts"], cache_dir=None)
+    assert not k.contains("web-01")
+
+def test_cache(tmp_path):
+    built = knownhosts(tmp_path, cache_dir=tmp_path / "cache")
+    assert list((tmp_path / "cache").glob("knownhosts-*.pickle"))
+    cached = knownhosts(tmp_path, cache_dir=tmp_path / "cache")
+    for name in ("web-01", "[db]:2222", "secret", "host.lan", "bad.lan", "host.corp", "revoked"):
+        assert cached.contains(name) == built.contains(name)
+    # the cache follows changes of the file
+    (tmp_path / "known_hosts").write_text(KNOWN_HOSTS + "added ssh-ed25519 AAAA\n")
+    assert knownhosts(tmp_path, cache_dir=tmp_path / "cache").contains("added")
@@ -0,0 +1,54 @@
+# requests handled by Passagent, without its socket, run with: python3 -m pytest tests
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import ocsh
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def agent(tmp_path, monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(ocsh.time, 'monotonic', clock)
+    return ocsh.Passagent(sock_path=tmp_path / "agent.sock", **kwargs), clock
+
+def test_get_put(tmp_path, monkeypatch):
+    a, _ = agent(tmp_path, monkeypatch)
+    assert a._handle({'op': 'get', 'name': "web"}) == {'secret': None}
+    assert a._handle({'op': 'put', 'name': "web", 'secret': "pw"}) == {}
+    assert a._handle({'op': 'get', 'name': "web"}) == {'secret': "pw"}
+    assert a._handle({'op': 'ping'}) == {}
+    assert 'error' in a._handle({'op': 'unknown'})
+    assert not (tmp_path / "agent.sock").exists()
+
+def test_ttl(tmp_path, monkeypatch):
+    a, clock = agent(tmp_path, monkeypatch, ttl=60)
+    a._handle({'op': 'put', 'name': "web", 'secret': "pw"})
+    clock.now += 60
+    assert a._handle({'op': 'get', 'name': "web"}) == {'secret': "pw"}
+    clock.now += 1
+    assert a._handle({'op': 'get', 'name': "web"}) == {'secret': None}
+    assert not a.secrets
+
+def test_lru(tmp_path, monkeypatch):
+    a, _ = agent(tmp_path, monkeypatch, max_entries=2)
+    a._handle({'op': 'put', 'name': "a", 'secret': "1"})
+    a._handle({'op': 'put', 'name': "b", 'secret': "2"})
+    # reading 'a' makes 'b' the least recently used
+    a._handle({'op': 'get', 'name': "a"})
+    a._handle({'op': 'put', 'name': "c", 'secret': "3"})
+    assert list(a.secrets) == ["a", "c"]
+    assert a._handle({'op': 'get', 'name': "b"}) == {'secret': None}
+
+def test_flush(tmp_path, monkeypatch):
+    a, _ = agent(tmp_path, monkeypatch)
+    a._handle({'op': 'put', 'name': "a", 'secret': "1"})
+    a._handle({'op': 'put', 'name': "b", 'secret': "2"})
+    assert a._handle({'op': 'flush'}) == {'flushed': 2}
+    assert a._handle({'op': 'get', 'name': "a"}) == {'secret': None}
@@ -0,0 +1,33 @@
+# ProxyCommand forwarding with ssh, recognized by Octossh._proxy_hop(), run with: python3 -m pytest tests
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import ocsh
+
+@pytest.mark.parametrize("proxycommand, hop", [
+    ("ssh -W %h:%p bastion", "bastion"),
+    ("ssh -q -W %h:%p -l root -p 2222 bastion", "root@bastion:2222"),
+    ("ssh -W %h:%p -l u b:2200", "u@b:2200"),
+    ("/usr/bin/ssh -qW %h:%p ssh://u@b:22", "u@b:22"),
+    ("ssh root@b nc %h %p", "root@b"),
+    ("ssh b netcat %h %p", "b"),
+])
+def test_hop(proxycommand, hop):
+    assert ocsh.Octossh.__new__(ocsh.Octossh)._proxy_hop(proxycommand) == hop
+
+@pytest.mark.parametrize("proxycommand", [
+    "nc -X 5 %h %p", # not ssh
+    "ssh b", # no forwarding
+    "ssh -W %h:%p b uptime", # remote command
+    "ssh -W 10.0.0.1:22 b", # fixed destination
+    "ssh -i key -W %h:%p b", # options that would be lost
+    "ssh -F cfg -W %h:%p b",
+    "ssh -W %h:%p %r@b", # tokens in jump host
+    "ssh -W \"unclosed",
+])
+def test_not_hop(proxycommand):
+    assert ocsh.Octossh.__new__(ocsh.Octossh)._proxy_hop(proxycommand) is None
@@ -0,0 +1,129 @@
+# ssh_config(5) blocks matching of Sshconf.lookup(), run with: python3 -m pytest tests
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import ocsh
+
+CONFIG = """Host web-01 web-09
+    Hostname 10.0.0.1
+    # ocsh post up "uptime"
+Host web-* !web-bad
+    User www
+    # ocsh pass pweb
+    # ocsh post up "w"
+    # ocsh post logs "journalctl"
+Host db?
+    # ocsh pass pdb
+Match host 10.0.0.*
+    # ocsh post net "ip a"
+Match originalhost web-09
+    # ocsh pass p09
+Match exec "true"
+    # ocsh post never "x"
+Host *
+    User default
+    # ocsh pass pall
+Host lonely
+    User lonely
+    # ocsh login pexpect
+Host *
+    Port 2222
+    # ocsh pass plast
+Match originalhost lonely
+    # ocsh pre first
+Match originalhost lonely
+    # ocsh pre second
+    # ocsh cmd cmd-lonely
+"""
+
+def sshconf(tmp_path, cache_dir=None):
+    path = tmp_path / "config"
+    if not path.exists():
+        path.write_text(CONFIG)
+    return ocsh.Sshconf(path, cache_dir=cache_dir)
+
+def test_multiple_names(tmp_path):
+    c = sshconf(tmp_path)
+    for name in ("web-01", "web-09"):
+        assert c.lookup(name)['Hostname'] == "10.0.0.1"
+
+def test_negated_pattern(tmp_path):
+    c = sshconf(tmp_path)
+    assert c.lookup("web-02")['pass'] == "pweb"
+    assert c.lookup("web-bad")['pass'] == "pall"
+    assert c.lookup("web-bad")['User'] == "default"
+
+def test_wildcard_patterns(tmp_path):
+    c = sshconf(tmp_path)
+    assert c.lookup("db1")['pass'] == "pdb"
+    assert c.lookup("db12")['pass'] == "pall"
+
+def test_first_value_wins(tmp_path):
+    c = sshconf(tmp_path)
+    conf = c.lookup("web-01")
+    assert conf['User'] == "www"
+    assert conf['pass'] == "pweb"
+    assert conf['post'] == {'up': ["uptime", None], 'logs': ["journalctl", None], 'net': ["ip a", None]}
+    # Host * before Host lonely sets User first
+    assert c.lookup("lonely")['User'] == "default"
+
+def test_match(tmp_path):
+    c = sshconf(tmp_path)
+    # 'Match host' applies to the name after Hostname substitution, 'Match originalhost' to the name given
+    assert 'net' in c.lookup("web-09")['post']
+    assert 'net' not in c.lookup("web-02")['post']
+    assert c.lookup("web-09")['pass'] == "pweb"
+    # blocks with unsupported criteria never match
+    assert 'never' not in c.lookup("web-02")['post']
+
+def test_repeated_lines(tmp_path):
+    c = sshconf(tmp_path)
+    # both 'Host *' blocks apply, each at its own position
+    conf = c.lookup("lonely")
+    assert conf['Port'] == "2222"
+    assert conf['pass'] == "pall"
+    assert conf['login'] == "pexpect"
+    # both 'Match originalhost lonely' blocks apply, the first one winning
+    assert conf['pre'] == "first"
+    assert conf['cmd'] == "cmd-lonely"
+
+def test_index(tmp_path):
+    c = sshconf(tmp_path)
+    assert c.expand("web") == ["web-01", "web-09"]
+    assert c.actions["web-01"] == ["logs", "net", "up"]
+    assert "lonely" not in c.actions
+
+def test_cache(tmp_path):
+    built = sshconf(tmp_path, cache_dir=tmp_path / "cache")
+    cached = sshconf(tmp_path, cache_dir=tmp_path / "cache")
+    assert isinstance(cached.hosts, ocsh.Lazyhosts)
+    for name in ("web-01", "web-bad", "db1", "lonely"):
+        assert cached.lookup(name) == built.lookup(name)
+
+def test_cache_buckets(tmp_path, monkeypatch):
+    monkeypatch.setattr(ocsh.Sshconf, 'CACHE_BUCKETS_MIN', 2)
+    built = sshconf(tmp_path, cache_dir=tmp_path / "cache")
+    cached = sshconf(tmp_path, cache_dir=tmp_path / "cache")
+    # a single literal name only reads its own bucket
+    assert cached.lookup("lonely") == built.lookup("lonely")
+    assert len(cached.hosts.loaded) == 1
+    assert sorted(cached.hosts) == sorted(built.hosts)
+    # buckets of another build are ignored, the configuration being parsed again
+    for bucket in (tmp_path / "cache").glob("sshconf-*-*.pickle"):
+        bucket.unlink()
+    cached = sshconf(tmp_path, cache_dir=tmp_path / "cache")
+    assert cached.lookup("lonely") == built.lookup("lonely")
+
+def test_expand(tmp_path):
+    c = sshconf(tmp_path)
+    # regular expressions matched from the start of names, as re.match()
+    assert c.expand("web-0[19]") == ["web-01", "web-09"]
+    assert c.expand("web-09|lonely") == ["lonely", "web-09"]
+    assert c.expand("lonely") == ["lonely"]
+    # the character before *, ? or { is optional, so it is not part of the literal prefix
+    assert c.expand("lonelyx?") == ["lonely"]
+    assert c.expand("web-1*") == ["web-01", "web-09"]
+    assert c.expand("web-0{2}") == []
+    assert c.expand("x") == []
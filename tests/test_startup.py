@@ -0,0 +1,37 @@
+# start time of ocsh on large configurations, using the stubs of scripts/bench.py, run with: python3 -m pytest tests
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+import bench
+
+HOSTS = 5000
+
+def overhead(tmp_path, hosts, *args):
+    """ fastest of a few warm runs, cache built by the first one """
+    home = tmp_path / ("home-%d" % hosts)
+    conf = bench.write_config(tmp_path / ("conf-%d" % hosts), hosts, include_depth=2, jump_depth=1)
+    bench.write_known_hosts(home, hosts, jump_depth=1)
+    env = dict(os.environ, HOME=str(home), PATH="%s:%s" % (tmp_path / "bin", os.environ['PATH']))
+    env.pop('OCSH_AGENT_SOCK', None)
+    env.pop('XDG_RUNTIME_DIR', None)
+    run = lambda: bench.ocsh_run(env, "-F", str(conf), *args)
+    run()
+    return bench.timed(run, 3)['min']
+
+def test_transport_does_not_grow_with_configuration(tmp_path):
+    bench.write_stubs(tmp_path / "bin")
+    args = ("-W", "10.0.0.1:22", "host0")
+    small = overhead(tmp_path, 10, *args)
+    large = overhead(tmp_path, HOSTS, *args)
+    # coarse, parsing the configuration again would take several times longer
+    assert large - small < 0.1
+
+def test_warm_start_does_not_grow_with_configuration(tmp_path):
+    bench.write_stubs(tmp_path / "bin")
+    args = ("--ocsh-pretend", "host0")
+    small = overhead(tmp_path, 10, *args)
+    large = overhead(tmp_path, HOSTS, *args)
+    assert large - small < 0.1